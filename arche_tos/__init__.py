@@ -7,7 +7,12 @@ _ = TranslationStringFactory('arche_tos')
 
 def includeme(config):
     config.add_translation_dirs('arche_tos:locale/')
+    config.include('.stats')
+    config.include('.state')
+    config.include('.cache')
+    config.include('.consent_index')
     config.include('.models')
+    config.include('.notifications')
     config.include('.resource')
     config.include('.schemas')
     config.include('.views')
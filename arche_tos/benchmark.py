@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks for the code that runs on every view.
+
+    Builds a synthetic site in an in-memory ZODB and measures the TOS check
+    for a number of scenarios. Results are written as JSON so they can be
+    compared between runs:
+
+        arche_tos_benchmark --tos 50 --users 1000 --langs sv,en,de > result.json
+"""
+import argparse
+import json
+import sys
+import time
+from random import Random
+
+import colander
+import transaction
+from arche.resources import Folder
+from arche.resources import User
+from arche.security import ROLE_ADMIN
+from arche.testing import barebone_fixture
+from pyramid import testing
+from pyramid.request import apply_request_extensions
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from arche_tos.exceptions import TermsNeedAcceptance
+from arche_tos.exceptions import TermsNotAccepted
+from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import ITOSManager
+from arche_tos.resource import TOS
+from arche_tos.schemas import OnlyAdministratorsWithEmailValidator
+
+
+SCENARIOS = ("checked", "unchecked", "grace_period", "admin", "settings_validation")
+
+
+class SyntheticSite(object):
+    """ An Arche root with TOS and users stored in an in-memory database. """
+
+    def __init__(self, tos_count, user_count, langs, enabled_ratio=0.5, seed=1):
+        self.random = Random(seed)
+        self.langs = langs
+        self.config = testing.setUp(
+            settings={"arche.debug": False}, request=testing.DummyRequest()
+        )
+        self.config.include("arche.testing")
+        self.config.include("arche.testing.catalog")
+        self.config.include("arche_tos")
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        zodb_root = self.conn.root()
+        self.root = zodb_root["app_root"] = barebone_fixture(self.config)
+        transaction.commit()
+        self.tos_uids = self._create_tos(tos_count, enabled_ratio)
+        self.userids = self._create_users(user_count)
+        self.root.local_roles[self.userids[0]] = [ROLE_ADMIN]
+        transaction.commit()
+
+    def _create_tos(self, count, enabled_ratio):
+        folder = self.root["tos"] = Folder()
+        request = self.make_request()
+        uids = []
+        for i in range(count):
+            lang = self.random.choice(self.langs + [""])
+            tos = TOS(title="Terms %s" % i, body="<p>%s</p>" % ("Lorem ipsum " * 200), lang=lang)
+            folder["tos-%s" % i] = tos
+            if self.random.random() < enabled_ratio:
+                tos.workflow.do_transition("disabled:enabled", request, force=True)
+            uids.append(tos.uid)
+        return uids
+
+    def _create_users(self, count):
+        users = self.root["users"]
+        userids = []
+        for i in range(count):
+            userid = "user%s" % i
+            users[userid] = User(email="%s@betahaus.net" % userid)
+            userids.append(userid)
+        return userids
+
+    def agree_to_all(self, userid):
+        agreed = IAgreedTOS(self.root["users"][userid])
+        for uid in self.tos_uids:
+            agreed.accept_tos(uid)
+
+    def make_request(self, userid=None, lang="en", admin=False, session=None):
+        self.config.testing_securitypolicy(userid=userid, permissive=admin)
+        request = testing.DummyRequest()
+        request._LOCALE_ = lang
+        request.context = self.root
+        request.root = self.root
+        apply_request_extensions(request)
+        if session is not None:
+            request.session.update(session)
+        return request
+
+    def close(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        testing.tearDown()
+
+
+def run_check(request):
+    """ Returns the outcome of a check as a string. """
+    try:
+        ITOSManager(request).check_terms()
+    except TermsNeedAcceptance:
+        return "need_acceptance"
+    except TermsNotAccepted:
+        return "not_accepted"
+    return "ok"
+
+
+def run_settings_validation(site, request):
+    """ Validate the consent managers field of the settings form. """
+    kw = {"context": site.root, "request": request}
+    validator = OnlyAdministratorsWithEmailValidator.wrapped(None, kw)
+    try:
+        validator(None, set(site.userids[:1]))
+    except colander.Invalid:
+        return "invalid"
+    return "ok"
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def measure(site, scenario, iterations, cold=True):
+    """ Returns a dict with timing and object load statistics for scenario. """
+    agreed_userid = site.userids[0]
+    pending_userid = site.userids[-1]
+    site.agree_to_all(agreed_userid)
+    transaction.commit()
+    durations = []
+    loads = []
+    outcomes = {}
+    # Session state carried between requests, like a browser would
+    session = {}
+    for i in range(iterations):
+        lang = site.langs[i % len(site.langs)]
+        check = run_check
+        if scenario == "checked":
+            request = site.make_request(agreed_userid, lang, session=session)
+        elif scenario == "unchecked":
+            request = site.make_request(agreed_userid, lang)
+        elif scenario == "grace_period":
+            request = site.make_request(pending_userid, lang, session=session)
+        elif scenario == "admin":
+            request = site.make_request(agreed_userid, lang, admin=True)
+        elif scenario == "settings_validation":
+            request = site.make_request(agreed_userid, lang, admin=True)
+            check = lambda request: run_settings_validation(site, request)
+        else:
+            raise ValueError("No such scenario: %s" % scenario)
+        if cold:
+            site.conn.cacheMinimize()
+        site.conn.getTransferCounts(True)
+        start = time.perf_counter()
+        outcome = check(request)
+        durations.append((time.perf_counter() - start) * 1000)
+        loads.append(site.conn.getTransferCounts(True)[0])
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        session = dict(request.session)
+        transaction.abort()
+    return {
+        "iterations": iterations,
+        "mean_ms": sum(durations) / len(durations),
+        "p50_ms": _percentile(durations, 50),
+        "p95_ms": _percentile(durations, 95),
+        "max_ms": max(durations),
+        "mean_loads": float(sum(loads)) / len(loads),
+        "max_loads": max(loads),
+        "outcomes": outcomes,
+    }
+
+
+def run_benchmarks(tos_count, user_count, langs, iterations, scenarios=SCENARIOS, cold=True):
+    site = SyntheticSite(tos_count, user_count, langs)
+    try:
+        results = {}
+        for scenario in scenarios:
+            results[scenario] = measure(site, scenario, iterations, cold=cold)
+        return {
+            "params": {
+                "tos": tos_count,
+                "users": user_count,
+                "langs": langs,
+                "iterations": iterations,
+                "cold": cold,
+            },
+            "results": results,
+        }
+    finally:
+        site.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the per request TOS check.")
+    parser.add_argument("--tos", type=int, default=20, help="Number of TOS objects")
+    parser.add_argument("--users", type=int, default=1000, help="Number of users")
+    parser.add_argument("--langs", default="en,sv,de", help="Comma separated languages")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS, help="Defaults to all"
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="Don't clear the ZODB cache between requests"
+    )
+    args = parser.parse_args(argv)
+    result = run_benchmarks(
+        args.tos,
+        args.users,
+        [x.strip() for x in args.langs.split(",") if x.strip()],
+        args.iterations,
+        scenarios=args.scenario or SCENARIOS,
+        cold=not args.warm,
+    )
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+""" Agree or revoke for many users at once, for instance when migrating consent
+    from another system or when terms are withdrawn.
+"""
+import csv
+import json
+from datetime import datetime
+
+import transaction
+
+from arche_tos.cache import active_tos_cache
+from arche_tos.consent_log import date_timestamp
+from arche_tos.consent_log import log_consent
+from arche_tos.events import BulkAgreementsRevoked
+from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import IRevokedTOS
+from arche_tos.interfaces import ITOSManager
+from arche_tos.resource import split_consent_key
+
+
+class BulkResult(object):
+    def __init__(self):
+        self.processed = 0
+        self.changed = 0
+        self.failed = []
+        self.batches = 0
+
+    def __repr__(self):  # pragma: no cover
+        return "<BulkResult processed=%s changed=%s failed=%s batches=%s>" % (
+            self.processed,
+            self.changed,
+            len(self.failed),
+            self.batches,
+        )
+
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def read_rows(fp, fmt="csv"):
+    """ Yield (userid, tos_uid, date) from a file with the columns/keys
+        userid, tos_uid and date. Date is optional and in ISO format.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(fp)
+    elif fmt == "jsonl":
+        reader = (json.loads(line) for line in fp if line.strip())
+    else:
+        raise ValueError("Unknown format: %s" % fmt)
+    for row in reader:
+        yield row["userid"], row["tos_uid"], parse_date(row.get("date", None))
+
+
+def _agreed_keys(agreed, tos_uid):
+    return [x for x in agreed if split_consent_key(x)[0] == tos_uid]
+
+
+def _agree(user, tos_uid, date, key=None):
+    """ key is the consent key of the current version, defaults to tos_uid. """
+    if key is None:
+        key = tos_uid
+    agreed = IAgreedTOS(user)
+    if agreed.get(key, None) == date and date is not None:
+        return False
+    for other in _agreed_keys(agreed, tos_uid):
+        if other != key:
+            del agreed[other]
+    agreed.accept_tos(key, date)
+    revoked = IRevokedTOS(user)
+    if tos_uid in revoked:
+        del revoked[tos_uid]
+    return True
+
+
+def _revoke(user, tos_uid, date, key=None):
+    agreed = IAgreedTOS(user)
+    for other in _agreed_keys(agreed, tos_uid):
+        del agreed[other]
+    revoked = IRevokedTOS(user)
+    if tos_uid in revoked:
+        return False
+    revoked.revoke_tos(tos_uid, date)
+    return True
+
+
+ACTIONS = {"agree": _agree, "revoke": _revoke}
+
+
+def bulk_consent(
+    root, rows, action, batch_size=500, request=None, progress=None, commit=True
+):
+    """ Apply action ('agree' or 'revoke') to rows of (userid, tos_uid, date).
+        With a request, agreements to enabled TOS are stored for their current
+        consent version.
+
+        Each row is written within a savepoint, so a bad row is rolled back and
+        reported in the result without affecting the rest of the batch.
+        The transaction is committed every batch_size rows unless commit is False.
+
+        If a request is given, revocations of enabled TOS cause one
+        BulkAgreementsRevoked event per batch.
+        progress is called with the result after each batch.
+    """
+    func = ACTIONS[action]
+    users = root["users"]
+    result = BulkResult()
+    active = {}
+    revisions = {}
+    keys = {}
+    if request is not None:
+        # All enabled TOS regardless of language
+        items = active_tos_cache.get(request).items
+        revisions = dict([(x.uid, x.revision) for x in items])
+        keys = dict([(x.uid, x.consent_key) for x in items])
+        if action == "revoke":
+            active = dict([(x.uid, x) for x in items])
+    revoked = {}
+
+    def _end_batch():
+        if revoked:
+            _notify_revoked(request, revoked)
+            revoked.clear()
+        if commit:
+            transaction.commit()
+        result.batches += 1
+        if progress is not None:
+            progress(result)
+
+    for userid, tos_uid, date in rows:
+        result.processed += 1
+        savepoint = transaction.savepoint()
+        try:
+            if func(users[userid], tos_uid, date, keys.get(tos_uid, None)):
+                result.changed += 1
+                timestamp = date is not None and date_timestamp(date) or None
+                log_consent(
+                    root, userid, tos_uid, action, revisions.get(tos_uid), timestamp
+                )
+                if tos_uid in active:
+                    revoked.setdefault(userid, []).append(active[tos_uid])
+        except Exception as exc:
+            savepoint.rollback()
+            result.failed.append((userid, tos_uid, "%s: %s" % (exc.__class__.__name__, exc)))
+        if result.processed % batch_size == 0:
+            _end_batch()
+    if result.processed % batch_size or not result.processed:
+        _end_batch()
+    return result
+
+
+def _notify_revoked(request, revoked):
+    infos = {}
+    for tos_infos in revoked.values():
+        for info in tos_infos:
+            infos[info.uid] = info
+    tos_manager = ITOSManager(request)
+    found = dict([(x.uid, x) for x in tos_manager.resolve_tos_info(list(infos.values()))])
+    by_userid = {}
+    for userid, tos_infos in revoked.items():
+        by_userid[userid] = [found[x.uid] for x in tos_infos if x.uid in found]
+    request.registry.notify(BulkAgreementsRevoked(by_userid, request))
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_right
+from collections import OrderedDict
+from collections import namedtuple
+from hashlib import sha1
+from logging import getLogger
+from threading import Lock
+
+from arche.interfaces import IObjectAddedEvent
+from arche.interfaces import IObjectUpdatedEvent
+from arche.interfaces import IObjectWillBeRemovedEvent
+from arche.interfaces import IUser
+from arche.interfaces import IWorkflowAfterTransition
+from arche.utils import utcnow
+from BTrees.Length import Length
+from persistent import Persistent
+from pyramid.traversal import find_root
+from pyramid.traversal import resource_path_tuple
+from repoze.catalog.query import Any
+from repoze.catalog.query import Eq
+
+from arche_tos.interfaces import ITOS
+from arche_tos.interfaces import ITOSSettings
+from arche_tos.resource import consent_key
+
+logger = getLogger(__name__)
+
+class TOSInfo(
+    namedtuple(
+        "TOSInfo",
+        (
+            "uid",
+            "lang",
+            "title",
+            "is_active",
+            "docid",
+            "revision",
+            "collapse_text",
+            "path",
+            "consent_version",
+            "effective_from",
+            "expires_at",
+        ),
+    )
+):
+    __slots__ = ()
+
+    @property
+    def consent_key(self):
+        return consent_key(self.uid, self.consent_version)
+
+ConsentManagerInfo = namedtuple("ConsentManagerInfo", ("userid", "email", "title"))
+
+
+class ActiveTOSSnapshot(object):
+    """ Read-only information about all enabled TOS at a specific generation.
+        Never holds any persistent objects, so it's safe to share between threads.
+
+        TOS may have effective_from and expires_at set. Their times are kept as
+        sorted timelines, and a period is where now falls within them. What's
+        active only changes between periods, so results are cached per period.
+        started_at is compared to effective_from instead of now, to let users
+        see new terms at slightly different times.
+    """
+
+    def __init__(self, generation, items, modified=None):
+        self.generation = generation
+        self.modified = modified
+        self.items = tuple(items)
+        self.starts = sorted(set(x.effective_from for x in self.items if x.effective_from))
+        self.ends = sorted(set(x.expires_at for x in self.items if x.expires_at))
+        self._current = {}
+        self._by_locale = {}
+        self._uids = {}
+        self._consent_keys = {}
+        self._digests = {}
+
+    def period(self, now=None, started_at=None):
+        if not (self.starts or self.ends):
+            return (0, 0)
+        if now is None:
+            now = utcnow()
+        if started_at is None:
+            started_at = now
+        return (bisect_right(self.starts, started_at), bisect_right(self.ends, now))
+
+    def current(self, now=None, started_at=None):
+        """ Enabled TOS within their effective time, regardless of language. """
+        period = self.period(now, started_at)
+        try:
+            return self._current[period]
+        except KeyError:
+            pass
+        if not (self.starts or self.ends):
+            found = self.items
+        else:
+            if now is None:
+                now = utcnow()
+            if started_at is None:
+                started_at = now
+            found = tuple(
+                x
+                for x in self.items
+                if (x.effective_from is None or x.effective_from <= started_at)
+                and (x.expires_at is None or now < x.expires_at)
+            )
+        self._current[period] = found
+        return found
+
+    def for_locale(self, locale_name, now=None, started_at=None):
+        """ TOS relevant for locale_name, i.e. the ones without lang set
+            and the ones with that specific lang.
+        """
+        key = (locale_name, self.period(now, started_at))
+        try:
+            return self._by_locale[key]
+        except KeyError:
+            pass
+        found = tuple(
+            x
+            for x in self.current(now, started_at)
+            if not x.lang or x.lang == locale_name
+        )
+        self._by_locale[key] = found
+        return found
+
+    def uids(self, locale_name, now=None, started_at=None):
+        """ frozenset of the uids returned by for_locale. """
+        key = (locale_name, self.period(now, started_at))
+        try:
+            return self._uids[key]
+        except KeyError:
+            pass
+        found = frozenset(x.uid for x in self.for_locale(locale_name, now, started_at))
+        self._uids[key] = found
+        return found
+
+    def consent_keys(self, locale_name, now=None, started_at=None):
+        """ frozenset of the keys agreements to the TOS returned by for_locale
+            are stored with.
+        """
+        key = (locale_name, self.period(now, started_at))
+        try:
+            return self._consent_keys[key]
+        except KeyError:
+            pass
+        found = frozenset(
+            x.consent_key for x in self.for_locale(locale_name, now, started_at)
+        )
+        self._consent_keys[key] = found
+        return found
+
+    def digest(self, locale_name, now=None, started_at=None):
+        """ A short fingerprint of the uids and revisions returned by for_locale. """
+        key = (locale_name, self.period(now, started_at))
+        try:
+            return self._digests[key]
+        except KeyError:
+            pass
+        items = sorted(
+            "%s:%s" % (x.uid, x.revision)
+            for x in self.for_locale(locale_name, now, started_at)
+        )
+        found = sha1("\n".join(items).encode("utf-8")).hexdigest()[:16]
+        self._digests[key] = found
+        return found
+
+
+class ActiveTOSCache(object):
+    """ Process-wide cache of the enabled TOS, one snapshot per site.
+        A snapshot is only rebuilt when the persistent generation counter
+        on the root differs from the one the snapshot was built from.
+    """
+
+    stats_name = "active_tos_cache"
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = Lock()
+
+    def get(self, request, locale_name=None):
+        """ Snapshot of the TOS relevant for locale_name,
+            or all enabled TOS if locale_name is None.
+        """
+        root = request.root
+        generation = get_tos_generation(root)
+        key = (getattr(root, "uid", None), locale_name)
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None and snapshot.generation == generation:
+            request.tos_stats.incr("%s.hit" % self.stats_name)
+            return snapshot
+        request.tos_stats.incr("%s.miss" % self.stats_name)
+        snapshot = self.build(request, generation, locale_name)
+        # Never cache anything built within a transaction that changed the generation,
+        # it may still be aborted.
+        if not _generation_changed(root):
+            with self._lock:
+                self._snapshots[key] = snapshot
+        return snapshot
+
+    def build(self, request, generation, locale_name):
+        return build_snapshot(request, generation, locale_name)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+active_tos_cache = ActiveTOSCache()
+
+
+class TOSListingCache(ActiveTOSCache):
+    """ All TOS regardless of state, sorted by title. For listings. """
+
+    stats_name = "tos_listing_cache"
+
+    def build(self, request, generation, locale_name):
+        return build_listing(request, generation)
+
+
+tos_listing_cache = TOSListingCache()
+
+
+class FragmentCache(object):
+    """ Process-wide LRU cache for rendered HTML.
+        Keys must contain everything that affects the output, like revision and locale,
+        so nothing ever needs to be invalidated explicitly.
+    """
+
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+tos_fragment_cache = FragmentCache()
+# Rendered email bodies, with placeholders for anything specific to a recipient
+email_body_cache = FragmentCache(maxsize=100)
+
+
+class ConsentManagersCache(object):
+    """ Process-wide cache of the consent managers that can be emailed, per site.
+        Entries are tied to the serial of the stored TOS settings and to a
+        persistent counter on the root that's bumped when a consent manager
+        is changed or removed, so all processes see those changes.
+    """
+
+    def __init__(self):
+        self._managers = {}
+        self._lock = Lock()
+
+    def get(self, request):
+        """ Tuple of ConsentManagerInfo. """
+        root = request.root
+        data = ITOSSettings(root).data
+        version = (
+            getattr(data, "_p_serial", None),
+            get_consent_managers_generation(root),
+        )
+        key = getattr(root, "uid", None)
+        found = self._managers.get(key)
+        if found is not None and found[0] == version:
+            request.tos_stats.incr("consent_managers_cache.hit")
+            return found[1]
+        request.tos_stats.incr("consent_managers_cache.miss")
+        managers = build_consent_managers(request)
+        # Changes within this transaction may still be aborted
+        if (
+            not getattr(data, "_p_changed", False)
+            and getattr(data, "_p_oid", None)
+            and not _counter_changed(root, "_tos_managers_generation")
+        ):
+            with self._lock:
+                self._managers[key] = (version, managers)
+        return managers
+
+    def clear(self):
+        with self._lock:
+            self._managers.clear()
+
+
+consent_managers_cache = ConsentManagersCache()
+
+
+def build_snapshot(request, generation, locale_name=None):
+    catalog = request.root.catalog
+    query = Eq("type_name", "TOS") & Eq("wf_state", "enabled")
+    # Sites that haven't got the lang index yet will filter after loading instead
+    if locale_name is not None and "lang" in catalog:
+        query &= Any("lang", ["", locale_name])
+    with request.tos_stats.timer("catalog_query"):
+        docids = catalog.query(query)[1]
+    docids = tuple(docids)
+    request.tos_stats.incr("docids_resolved", len(docids))
+    items = _tos_infos(request, docids)
+    modified = get_tos_modified(request.root)
+    return ActiveTOSSnapshot(generation, items, modified)
+
+
+def build_listing(request, generation):
+    query = Eq("type_name", "TOS")
+    with request.tos_stats.timer("catalog_query"):
+        docids = request.root.catalog.query(query, sort_index="sortable_title")[1]
+    docids = tuple(docids)
+    request.tos_stats.incr("docids_resolved", len(docids))
+    items = _tos_infos(request, docids)
+    modified = get_tos_modified(request.root)
+    return ActiveTOSSnapshot(generation, items, modified)
+
+
+def _tos_infos(request, docids):
+    """ Body and revoke body are stored separately, so they're never loaded here. """
+    items = []
+    for docid in docids:
+        for tos in request.resolve_docids([docid], perm=None):
+            items.append(
+                TOSInfo(
+                    tos.uid,
+                    tos.lang,
+                    tos.title,
+                    tos.is_active,
+                    docid,
+                    tos.revision,
+                    tos.collapse_text,
+                    resource_path_tuple(tos)[1:],
+                    tos.consent_version,
+                    tos.effective_from,
+                    tos.expires_at,
+                )
+            )
+    return items
+
+
+def build_consent_managers(request):
+    settings = ITOSSettings(request.root)
+    users = request.root["users"]
+    found = []
+    for userid in settings.get("data_consent_managers", ()):
+        try:
+            user = users[userid]
+        except KeyError:
+            logger.warning("Set data consent manager userid '%s' doesn't exist.", userid)
+            continue
+        if user.email:
+            found.append(ConsentManagerInfo(userid, user.email, user.title))
+        else:
+            logger.warning(
+                "Set data consent manager userid '%s' doesn't have a valid email address.",
+                userid,
+            )
+    return tuple(found)
+
+
+class LastModified(Persistent):
+    """ When TOS were last changed. Kept out of the root, and concurrent
+        changes are resolved by keeping the latest time, like Length does
+        for the generation counter.
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def _p_resolveConflict(self, old_state, saved_state, new_state):
+        if saved_state["value"] > new_state["value"]:
+            return saved_state
+        return new_state
+
+
+def get_tos_modified(root):
+    modified = getattr(root, "_tos_last_modified", None)
+    if modified is not None:
+        return modified.value
+
+
+def get_tos_generation(root):
+    counter = getattr(root, "_tos_generation", None)
+    if counter is None:
+        return 0
+    return counter()
+
+
+def bump_tos_generation(root):
+    counter = getattr(root, "_tos_generation", None)
+    if counter is None:
+        counter = root._tos_generation = Length()
+    counter.change(1)
+    modified = getattr(root, "_tos_last_modified", None)
+    if modified is None:
+        modified = root._tos_last_modified = LastModified()
+    modified.value = utcnow()
+
+
+def _generation_changed(root):
+    return _counter_changed(root, "_tos_generation")
+
+
+def _counter_changed(root, attr):
+    counter = getattr(root, attr, None)
+    if counter is None:
+        return False
+    return counter._p_changed or counter._p_oid is None
+
+
+def get_consent_managers_generation(root):
+    counter = getattr(root, "_tos_managers_generation", None)
+    if counter is None:
+        return 0
+    return counter()
+
+
+def bump_consent_managers_generation(root):
+    counter = getattr(root, "_tos_managers_generation", None)
+    if counter is None:
+        counter = root._tos_managers_generation = Length()
+    counter.change(1)
+
+
+def invalidate_active_tos(tos, event):
+    """ Any change to a TOS object causes a new generation. """
+    bump_tos_generation(find_root(tos))
+
+
+def bump_tos_revision(tos, event):
+    """ Edits of the TOS itself causes a new revision, workflow changes don't. """
+    changed = getattr(event, "changed", None)
+    if changed and set(changed) <= {"wf_state"}:
+        return
+    tos.revision += 1
+
+
+def invalidate_consent_managers(user, event):
+    """ Email and title of consent managers are part of the cache.
+        Changes to other users don't matter, so they don't write anything.
+    """
+    root = find_root(user)
+    if user.userid in ITOSSettings(root).get("data_consent_managers", ()):
+        bump_consent_managers_generation(root)
+
+
+def includeme(config):
+    for event_iface in (
+        IObjectAddedEvent,
+        IObjectUpdatedEvent,
+        IObjectWillBeRemovedEvent,
+        IWorkflowAfterTransition,
+    ):
+        config.add_subscriber(invalidate_active_tos, [ITOS, event_iface])
+    config.add_subscriber(bump_tos_revision, [ITOS, IObjectUpdatedEvent])
+    for event_iface in (IObjectUpdatedEvent, IObjectWillBeRemovedEvent):
+        config.add_subscriber(invalidate_consent_managers, [IUser, event_iface])
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+""" Optional compact storage of consent on users.
+
+    Instead of a mapping with uid strings and date objects, each user gets a
+    small record with TOS ordinals and day numbers in arrays, plus a bitset of
+    the ordinals. TOS uids are interned once per site.
+
+    Enable with arche_tos.compact_consent = true and migrate existing users with
+    arche_tos_compact <ini file>. Users that haven't been migrated are still
+    readable, and are converted the first time their consent changes.
+"""
+from array import array
+from collections.abc import MutableMapping
+from datetime import date
+
+from arche.interfaces import IRoot
+from arche.interfaces import IUser
+from arche.utils import utcnow
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from persistent import Persistent
+from pyramid.traversal import find_root
+from zope.component import adapter
+from zope.interface import implementer
+
+from arche_tos.consent_index import get_consent_index
+from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import IRevokedTOS
+
+
+class TOSOrdinals(Persistent):
+    """ Interned TOS uids, each uid gets a small integer. """
+
+    def __init__(self):
+        self.by_uid = OIBTree()
+        self.by_ordinal = IOBTree()
+
+    def get(self, uid, default=None):
+        return self.by_uid.get(uid, default)
+
+    def ordinal(self, uid):
+        """ Get or create the ordinal for uid. """
+        try:
+            return self.by_uid[uid]
+        except KeyError:
+            pass
+        ordinal = len(self.by_ordinal)
+        self.by_uid[uid] = ordinal
+        self.by_ordinal[ordinal] = uid
+        return ordinal
+
+    def uid(self, ordinal):
+        return self.by_ordinal[ordinal]
+
+    def mask(self, uids):
+        """ Bitset of uids. Unknown uids can't have been agreed to by anyone,
+            so None is returned if there are any.
+        """
+        mask = 0
+        for uid in uids:
+            ordinal = self.by_uid.get(uid, None)
+            if ordinal is None:
+                return None
+            mask |= 1 << ordinal
+        return mask
+
+
+def get_ordinals(root, create=True):
+    ordinals = getattr(root, "_tos_ordinals", None)
+    if ordinals is None and create:
+        ordinals = root._tos_ordinals = TOSOrdinals()
+    return ordinals
+
+
+class CompactConsent(Persistent):
+    """ Parallel arrays of TOS ordinals and day numbers (date.toordinal),
+        and a bitset of the ordinals for fast subset tests.
+    """
+
+    __slots__ = ("ordinals", "days", "mask")
+
+    def __init__(self):
+        self.ordinals = array("I")
+        self.days = array("I")
+        self.mask = 0
+
+    def get(self, ordinal, default=None):
+        if not self.mask & (1 << ordinal):
+            return default
+        return self.days[self.ordinals.index(ordinal)]
+
+    def set(self, ordinal, day):
+        if self.mask & (1 << ordinal):
+            self.days[self.ordinals.index(ordinal)] = day
+        else:
+            self.ordinals.append(ordinal)
+            self.days.append(day)
+            self.mask |= 1 << ordinal
+        self._p_changed = True
+
+    def remove(self, ordinal):
+        if not self.mask & (1 << ordinal):
+            raise KeyError(ordinal)
+        i = self.ordinals.index(ordinal)
+        del self.ordinals[i]
+        del self.days[i]
+        self.mask &= ~(1 << ordinal)
+        self._p_changed = True
+
+    def covers(self, mask):
+        return self.mask & mask == mask
+
+    def __iter__(self):
+        return iter(zip(self.ordinals, self.days))
+
+    def __len__(self):
+        return len(self.ordinals)
+
+
+class CompactConsentAnnotations(MutableMapping):
+    """ Same interface as the AttributeAnnotations based storage,
+        uid as key and date as value.
+        Reading never writes anything, the ordinals are only created on change.
+    """
+
+    attr_name = None
+    legacy_attr_name = None
+    index_kind = None
+
+    def __init__(self, context):
+        self.context = context
+        root = find_root(context)
+        if not IRoot.providedBy(root):
+            raise ValueError("%r isn't placed within a site" % context)
+        self.root = root
+
+    @property
+    def tos_ordinals(self):
+        """ None until anything has been stored in a compact record. """
+        return get_ordinals(self.root, create=False)
+
+    def _ordinal(self, uid):
+        ordinals = self.tos_ordinals
+        if ordinals is not None:
+            return ordinals.get(uid)
+
+    @property
+    def record(self):
+        return getattr(self.context, self.attr_name, None)
+
+    @property
+    def legacy(self):
+        """ Storage from before migration. """
+        return getattr(self.context, self.legacy_attr_name, None)
+
+    def _writable_record(self):
+        record = self.record
+        if record is None:
+            record = CompactConsent()
+            legacy = self.legacy
+            if legacy is not None:
+                ordinals = get_ordinals(self.root)
+                for uid, value in legacy.items():
+                    record.set(ordinals.ordinal(uid), value.toordinal())
+                delattr(self.context, self.legacy_attr_name)
+            setattr(self.context, self.attr_name, record)
+        return record
+
+    def __getitem__(self, uid):
+        record = self.record
+        if record is None:
+            legacy = self.legacy
+            if legacy is None:
+                raise KeyError(uid)
+            return legacy[uid]
+        ordinal = self._ordinal(uid)
+        if ordinal is None:
+            raise KeyError(uid)
+        day = record.get(ordinal)
+        if day is None:
+            raise KeyError(uid)
+        return date.fromordinal(day)
+
+    def __setitem__(self, uid, value):
+        ordinal = get_ordinals(self.root).ordinal(uid)
+        self._writable_record().set(ordinal, value.toordinal())
+        get_consent_index(self.root).add(
+            self.index_kind, uid, self.context.userid, value
+        )
+
+    def __delitem__(self, uid):
+        # Migrate first, legacy uids aren't interned until then
+        record = self._writable_record()
+        ordinal = self._ordinal(uid)
+        if ordinal is None:
+            raise KeyError(uid)
+        record.remove(ordinal)
+        get_consent_index(self.root).remove(self.index_kind, uid, self.context.userid)
+
+    def __iter__(self):
+        record = self.record
+        if record is None:
+            return iter(self.legacy or ())
+        ordinals = self.tos_ordinals
+        return (ordinals.uid(x) for x, _day in record)
+
+    def __len__(self):
+        record = self.record
+        if record is None:
+            return len(self.legacy or ())
+        return len(record)
+
+    def missing(self, uids):
+        """ frozenset of uids that aren't keys here. A bitset test when nothing's missing. """
+        record = self.record
+        ordinals = self.tos_ordinals
+        if record is not None and ordinals is not None:
+            mask = ordinals.mask(uids)
+            if mask is not None and record.covers(mask):
+                return frozenset()
+        return frozenset(uids) - frozenset(self)
+
+
+@adapter(IUser)
+@implementer(IAgreedTOS)
+class CompactAgreedTOS(CompactConsentAnnotations):
+    attr_name = "_agreed_tos_compact"
+    legacy_attr_name = "_agreed_tos"
+    index_kind = "agreed"
+
+    def accept_tos(self, uid, date=None):
+        if date is None:
+            date = utcnow().date()
+        self[uid] = date
+
+
+@adapter(IUser)
+@implementer(IRevokedTOS)
+class CompactRevokedTOS(CompactConsentAnnotations):
+    attr_name = "_revoked_tos_compact"
+    legacy_attr_name = "_revoked_tos"
+    index_kind = "revoked"
+
+    def revoke_tos(self, uid, date=None):
+        if date is None:
+            date = utcnow().date()
+        self[uid] = date
+
+
+def migrate_to_compact(root, users=None):
+    """ Convert all users consent to compact records. Returns number of users changed. """
+    if users is None:
+        users = root["users"].values()
+    changed = 0
+    for user in users:
+        found = False
+        for adapter_cls in (CompactAgreedTOS, CompactRevokedTOS):
+            if getattr(user, adapter_cls.legacy_attr_name, None) is not None:
+                adapter_cls(user)._writable_record()
+                found = True
+        changed += found
+    return changed
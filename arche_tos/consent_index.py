@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from logging import getLogger
+
+from arche.interfaces import IObjectWillBeRemovedEvent
+from arche.interfaces import IRoot
+from arche.interfaces import IUser
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from pyramid.traversal import find_root
+
+from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import IRevokedTOS
+from arche_tos.resource import split_consent_key
+
+logger = getLogger(__name__)
+
+
+class ConsentIndex(Persistent):
+    """ Reverse index of consent, so we never have to wake up every user
+        to find out who agreed to or revoked something.
+
+        Structure is kind -> key -> userid -> date,
+        where kind is either 'agreed' or 'revoked'. Revocations are keyed on
+        the TOS uid, agreements on the consent key, which is uid@version for
+        later consent versions. See arche_tos.resource.consent_key.
+
+        It also keeps counters per key, and the number of users per day
+        (date.toordinal) for the current dates, so statistics never need to
+        go through the users. All counters are Length objects, so concurrent
+        changes don't cause conflict errors.
+    """
+
+    kinds = ("agreed", "revoked")
+    built = False
+
+    def __init__(self):
+        self.agreed = OOBTree()
+        self.revoked = OOBTree()
+        self.counts = OOBTree()
+        self.days = OOBTree()
+
+    def _storage(self, kind):
+        if kind not in self.kinds:
+            raise ValueError("No such kind: %s" % kind)
+        return getattr(self, kind)
+
+    def add(self, kind, tos_uid, userid, date):
+        storage = self._storage(kind)
+        try:
+            users = storage[tos_uid]
+        except KeyError:
+            users = storage[tos_uid] = OOBTree()
+        previous = users.get(userid, None)
+        users[userid] = date
+        if previous is None:
+            self._counter(kind, tos_uid).change(1)
+        else:
+            self._change_day(kind, tos_uid, previous, -1)
+        self._change_day(kind, tos_uid, date, 1)
+
+    def remove(self, kind, tos_uid, userid):
+        storage = self._storage(kind)
+        users = storage.get(tos_uid, None)
+        if users is not None and userid in users:
+            previous = users.pop(userid)
+            self._counter(kind, tos_uid).change(-1)
+            self._change_day(kind, tos_uid, previous, -1)
+
+    def _counter(self, kind, tos_uid):
+        key = (kind, tos_uid)
+        try:
+            return self.counts[key]
+        except KeyError:
+            counter = self.counts[key] = Length()
+            return counter
+
+    def _change_day(self, kind, tos_uid, day, delta):
+        key = (kind, tos_uid)
+        try:
+            days = self.days[key]
+        except KeyError:
+            days = self.days[key] = IOBTree()
+        day = day.toordinal()
+        try:
+            counter = days[day]
+        except KeyError:
+            counter = days[day] = Length()
+        # Days that reach 0 are kept, removing them could conflict with an increment
+        counter.change(delta)
+
+    def count(self, kind, tos_uid):
+        """ Number of users, without touching the users themselves. """
+        counter = self.counts.get((kind, tos_uid), None)
+        return counter is not None and counter() or 0
+
+    def histogram(self, kind, tos_uid, start=None, end=None):
+        """ List of (date, number of users) for all days with any users,
+            optionally limited to start and end (dates, inclusive).
+        """
+        days = self.days.get((kind, tos_uid), None)
+        if days is None:
+            return []
+        if start is not None:
+            start = start.toordinal()
+        if end is not None:
+            end = end.toordinal()
+        found = []
+        for k, counter in days.items(min=start, max=end):
+            value = counter()
+            if value > 0:
+                found.append((date.fromordinal(k), value))
+        return found
+
+    def get_users(self, kind, tos_uid):
+        """ Returns an OOBTree (or empty dict) with userid as key and date as value. """
+        return self._storage(kind).get(tos_uid, {})
+
+    def tos_uids(self, kind):
+        return self._storage(kind).keys()
+
+    def remove_user(self, userid):
+        """ Remove everything about userid, for instance when the user is deleted. """
+        for kind in self.kinds:
+            for key in list(self._storage(kind).keys()):
+                self.remove(kind, key, userid)
+
+    def keys_for(self, kind, tos_uid):
+        """ Keys stored for tos_uid, any consent version. """
+        for key in self._storage(kind).keys(min=tos_uid):
+            if not key.startswith(tos_uid):
+                break
+            if split_consent_key(key)[0] == tos_uid:
+                yield key
+
+    def collect(self, kind, tos_uids=None):
+        """ Returns a dict with userid as key and a dict with tos uid -> date as value.
+            Agreements to any consent version count. Only touches the index
+            entries for tos_uids.
+        """
+        if tos_uids is None:
+            keys = self.tos_uids(kind)
+        else:
+            keys = [key for tos_uid in tos_uids for key in self.keys_for(kind, tos_uid)]
+        found = {}
+        for key in keys:
+            tos_uid = split_consent_key(key)[0]
+            for userid, date in self.get_users(kind, key).items():
+                found.setdefault(userid, {})[tos_uid] = date
+        return found
+
+    def clear(self):
+        self.agreed.clear()
+        self.revoked.clear()
+        self.counts.clear()
+        self.days.clear()
+        self.built = False
+
+
+def get_consent_index(root, create=True):
+    index = getattr(root, "_tos_consent_index", None)
+    if index is None and create:
+        index = root._tos_consent_index = ConsentIndex()
+    return index
+
+
+def get_consent_index_for(user):
+    """ Find the index from a user object. Returns None if the user isn't
+        placed within a site yet.
+    """
+    root = find_root(user)
+    if IRoot.providedBy(root):
+        return get_consent_index(root)
+
+
+def rebuild_consent_index(root):
+    """ Read agreements and revocations from all users.
+        This wakes up every user object, so it's meant to be run from a script.
+    """
+    index = get_consent_index(root)
+    index.clear()
+    for i, user in enumerate(root["users"].values(), 1):
+        for tos_uid, date in IAgreedTOS(user).items():
+            index.add("agreed", tos_uid, user.userid, date)
+        for tos_uid, date in IRevokedTOS(user).items():
+            index.add("revoked", tos_uid, user.userid, date)
+        if i % 1000 == 0:
+            logger.info("Indexed consent for %s users", i)
+    index.built = True
+    return index
+
+
+def remove_deleted_user(user, event):
+    """ Deleted users shouldn't be counted anymore. """
+    root = find_root(user)
+    if IRoot.providedBy(root):
+        index = get_consent_index(root, create=False)
+        if index is not None:
+            index.remove_user(user.userid)
+
+
+def includeme(config):
+    config.add_subscriber(remove_deleted_user, [IUser, IObjectWillBeRemovedEvent])
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+""" Append-only log of every agreement and revocation.
+
+    Users only keep the date of their latest agreement or revocation, while the
+    log keeps every event with a full timestamp and the TOS revision. It's stored
+    on the root and never touches the users.
+
+    New events are appended to a small tree of recent events. Compaction moves
+    them into one read-only segment per day, with indexes by userid and TOS uid.
+    Run arche_tos_compact_log <ini file> daily, for instance from cron.
+"""
+from collections import namedtuple
+from datetime import datetime
+from datetime import timezone
+
+from arche.utils import utcnow
+from BTrees.IOBTree import IOBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+ConsentEvent = namedtuple(
+    "ConsentEvent", ("timestamp", "userid", "tos_uid", "revision", "action")
+)
+
+ACTIONS = ("agree", "revoke")
+
+
+def _day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date().toordinal()
+
+
+class ConsentLogSegment(Persistent):
+    """ All events of one day, sorted by time. Never changed after compaction,
+        except when late events for that day are merged in.
+    """
+
+    def __init__(self, events):
+        self.events = tuple(sorted(events, key=lambda x: x[:3]))
+        by_user = {}
+        by_tos = {}
+        for i, event in enumerate(self.events):
+            by_user.setdefault(event.userid, []).append(i)
+            by_tos.setdefault(event.tos_uid, []).append(i)
+        self.by_user = dict((k, tuple(v)) for k, v in by_user.items())
+        self.by_tos = dict((k, tuple(v)) for k, v in by_tos.items())
+
+    def query(self, userid=None, tos_uid=None):
+        if userid is not None:
+            positions = self.by_user.get(userid, ())
+            if tos_uid is not None:
+                positions = [x for x in positions if self.events[x].tos_uid == tos_uid]
+        elif tos_uid is not None:
+            positions = self.by_tos.get(tos_uid, ())
+        else:
+            return self.events
+        return [self.events[x] for x in positions]
+
+    def __len__(self):
+        return len(self.events)
+
+
+class ConsentLog(Persistent):
+    """ Events are stored as ConsentEvent, timestamps as seconds since the epoch (UTC). """
+
+    def __init__(self):
+        # (timestamp, userid, tos_uid) -> (revision, action)
+        self.recent = OOBTree()
+        # day ordinal -> ConsentLogSegment
+        self.segments = IOBTree()
+        # userid or TOS uid -> day ordinals with segments containing them
+        self.user_days = OOBTree()
+        self.tos_days = OOBTree()
+
+    def append(self, userid, tos_uid, action, revision=None, timestamp=None):
+        if action not in ACTIONS:
+            raise ValueError("No such action: %s" % action)
+        if timestamp is None:
+            timestamp = utcnow().timestamp()
+        key = (timestamp, userid, tos_uid)
+        # Same user and TOS within the same microsecond, keep both
+        while key in self.recent:
+            timestamp += 0.000001
+            key = (timestamp, userid, tos_uid)
+        self.recent[key] = (revision, action)
+        return ConsentEvent(timestamp, userid, tos_uid, revision, action)
+
+    def compact(self, before=None):
+        """ Move recent events from days before the date before (default today)
+            to segments. Returns the number of events moved.
+        """
+        if before is None:
+            before = utcnow().date()
+        limit = datetime(before.year, before.month, before.day, tzinfo=timezone.utc)
+        by_day = {}
+        keys = list(self.recent.keys(max=(limit.timestamp(),), excludemax=True))
+        for key in keys:
+            revision, action = self.recent[key]
+            event = ConsentEvent(key[0], key[1], key[2], revision, action)
+            by_day.setdefault(_day(event.timestamp), []).append(event)
+        for day, events in by_day.items():
+            existing = self.segments.get(day, None)
+            if existing is not None:
+                events = list(existing.events) + events
+            self.segments[day] = ConsentLogSegment(events)
+            for event in events:
+                self._days(self.user_days, event.userid).insert(day)
+                self._days(self.tos_days, event.tos_uid).insert(day)
+        for key in keys:
+            del self.recent[key]
+        return len(keys)
+
+    def _days(self, tree, key):
+        try:
+            return tree[key]
+        except KeyError:
+            days = tree[key] = IITreeSet()
+            return days
+
+    def query(self, userid=None, tos_uid=None, start=None, end=None):
+        """ Yield ConsentEvent in time order. start and end are timezone aware
+            datetimes, start inclusive and end exclusive.
+            Only segments that contain the userid or TOS are loaded.
+        """
+        start_ts = start_day = end_ts = end_day = None
+        if start is not None:
+            start_ts = start.timestamp()
+            start_day = _day(start_ts)
+        if end is not None:
+            end_ts = end.timestamp()
+            end_day = _day(end_ts)
+        if userid is not None:
+            days = self.user_days.get(userid, ())
+        elif tos_uid is not None:
+            days = self.tos_days.get(tos_uid, ())
+        else:
+            days = self.segments
+        if days:
+            days = days.keys(min=start_day, max=end_day)
+        for day in days:
+            for event in self.segments[day].query(userid, tos_uid):
+                if _in_range(event, start_ts, end_ts):
+                    yield event
+        recent_min = None
+        if start_ts is not None:
+            recent_min = (start_ts,)
+        for key, (revision, action) in self.recent.items(min=recent_min):
+            event = ConsentEvent(key[0], key[1], key[2], revision, action)
+            if end_ts is not None and event.timestamp >= end_ts:
+                break
+            if userid is not None and event.userid != userid:
+                continue
+            if tos_uid is not None and event.tos_uid != tos_uid:
+                continue
+            yield event
+
+    def __len__(self):
+        return len(self.recent) + sum(len(x) for x in self.segments.values())
+
+
+def _in_range(event, start_ts, end_ts):
+    if start_ts is not None and event.timestamp < start_ts:
+        return False
+    if end_ts is not None and event.timestamp >= end_ts:
+        return False
+    return True
+
+
+def get_consent_log(root, create=True):
+    log = getattr(root, "_tos_consent_log", None)
+    if log is None and create:
+        log = root._tos_consent_log = ConsentLog()
+    return log
+
+
+def log_consent(root, userid, tos_uid, action, revision=None, timestamp=None):
+    return get_consent_log(root).append(
+        userid, tos_uid, action, revision=revision, timestamp=timestamp
+    )
+
+
+def date_timestamp(date):
+    """ Midnight UTC of date, for events where only the date is known. """
+    return datetime(date.year, date.month, date.day, tzinfo=timezone.utc).timestamp()
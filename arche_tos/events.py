@@ -2,6 +2,7 @@ from arche.interfaces import IUser
 from pyramid.interfaces import IRequest
 from zope.interface import implementer
 
+from arche_tos.interfaces import IBulkAgreementsRevoked
 from arche_tos.interfaces import IImportantAgreementsRevoked
 from arche_tos.interfaces import ITOS
 
@@ -22,3 +23,20 @@ class ImportantAgreementsRevoked(object):
         self.user = user
         self.revoked_tos = revoked_tos
         self.request = request
+
+
+@implementer(IBulkAgreementsRevoked)
+class BulkAgreementsRevoked(object):
+    """ Several users no longer consent to things that are still active.
+        Fired once per batch by bulk operations, instead of one
+        ImportantAgreementsRevoked per user.
+    """
+
+    def __init__(self, revoked, request):
+        # userid as key, list of TOS as value
+        for tos_list in revoked.values():
+            for tos in tos_list:
+                assert ITOS.providedBy(tos)
+        assert IRequest.providedBy(request)
+        self.revoked = revoked
+        self.request = request
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+""" Streaming exports of consent data.
+
+    Responses are written while the WSGI server iterates them, which happens
+    after the request's own ZODB connection has been closed.
+    Everything needed is therefore either collected up front as plain values,
+    or loaded through a separate connection owned by the iterator.
+
+    The full consent export (export_consent) works on a database connection
+    alone, without a request or any registered components. It's written in
+    chunks of users, each as a separate gzip member, with a checkpoint after
+    each chunk so an interrupted export can continue where it stopped.
+"""
+import csv
+import gzip
+import json
+import os
+from bisect import bisect_right
+from io import StringIO
+
+import transaction
+from pyramid.traversal import find_resource
+from repoze.catalog.query import Eq
+
+from arche_tos.compact import CompactAgreedTOS
+from arche_tos.compact import CompactRevokedTOS
+from arche_tos.consent_index import get_consent_index
+from arche_tos.resource import split_consent_key
+
+
+class SeparateConnection(object):
+    """ Opens a new connection to the same database as obj.
+        Use as a context manager, changes are always aborted.
+    """
+
+    def __init__(self, obj):
+        self.db = obj._p_jar.db()
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = self.db.open(transaction_manager=self.transaction_manager)
+        return self.connection
+
+    def __exit__(self, *args):
+        self.transaction_manager.abort()
+        self.connection.close()
+
+
+def iter_revoked_users(root, tos_uids):
+    """ Yield (user, dict with tos uid -> date) for users who revoked any of tos_uids.
+        Walks the consent index one TOS uid at a time, or all users if the
+        index isn't built. Nothing is collected up front, so root should
+        belong to a connection that's only used for this.
+    """
+    users = root["users"]
+    index = get_consent_index(root, create=False)
+    if index is not None and index.built:
+        for uid in tos_uids:
+            for userid, date in index.get_users("revoked", uid).items():
+                user = users.get(userid, None)
+                if user is not None:
+                    yield user, {uid: date}
+    else:
+        tos_uids = frozenset(tos_uids)
+        for user in users.values():
+            revoked = dict(
+                (k, v) for k, v in CompactRevokedTOS(user).items() if k in tos_uids
+            )
+            if revoked:
+                yield user, revoked
+
+
+def iter_revoked_rows(revoked_users, tos_titles, conn, minimize_every=500):
+    """ Yield one dict per revoked agreement.
+
+        revoked_users: (user, dict with tos uid -> date), see iter_revoked_users.
+        tos_titles: tos uid -> title
+    """
+    for i, (user, revoked) in enumerate(revoked_users, 1):
+        for uid, date in sorted(revoked.items()):
+            yield {
+                "userid": user.userid,
+                "name": user.title,
+                "email": user.email,
+                "tos_uid": uid,
+                "tos_title": tos_titles.get(uid, ""),
+                "revoked": date.isoformat(),
+            }
+        if i % minimize_every == 0:
+            conn.cacheMinimize()
+
+
+def csv_lines(rows, fieldnames):
+    """ Encode rows as CSV, one chunk per row. """
+    buf = StringIO()
+    writer = csv.DictWriter(buf, fieldnames, extrasaction="ignore")
+    writer.writeheader()
+    yield buf.getvalue().encode("utf-8")
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        yield buf.getvalue().encode("utf-8")
+
+
+def jsonl_lines(rows):
+    """ Encode rows as JSON-lines, one chunk per row. """
+    for row in rows:
+        yield (json.dumps(row, sort_keys=True) + "\n").encode("utf-8")
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+}
+
+
+def encode_rows(rows, fmt, fieldnames):
+    if fmt == "csv":
+        return csv_lines(rows, fieldnames)
+    if fmt == "jsonl":
+        return jsonl_lines(rows)
+    raise ValueError("Unknown format: %s" % fmt)
+
+
+CONSENT_FIELDNAMES = (
+    "userid",
+    "name",
+    "email",
+    "state",
+    "date",
+    "tos_uid",
+    "tos_title",
+    "tos_revision",
+    "tos_lang",
+    "consent_version",
+)
+
+
+def tos_catalog_info(root):
+    """ Dict with uid as key and a dict with title, revision and lang of all TOS. """
+    found = {}
+    for docid in root.catalog.query(Eq("type_name", "TOS"))[1]:
+        tos = find_resource(root, root.document_map.address_for_docid(docid))
+        found[tos.uid] = {"title": tos.title, "revision": tos.revision, "lang": tos.lang}
+    return found
+
+
+def user_consent_rows(user, tos_info):
+    """ Yield one dict per agreed and revoked TOS of user.
+        Reads the users storage directly, regardless of compact records.
+    """
+    for state, storage in (
+        ("agreed", CompactAgreedTOS(user)),
+        ("revoked", CompactRevokedTOS(user)),
+    ):
+        for key, date in sorted(storage.items()):
+            uid, consent_version = split_consent_key(key)
+            info = tos_info.get(uid, {})
+            yield {
+                "userid": user.userid,
+                "name": user.title,
+                "email": user.email,
+                "state": state,
+                "date": date.isoformat(),
+                "tos_uid": uid,
+                "tos_title": info.get("title", ""),
+                "tos_revision": info.get("revision", None),
+                "tos_lang": info.get("lang", ""),
+                "consent_version": consent_version,
+            }
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_checkpoint(path, values):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(values, f)
+    os.rename(tmp, path)
+
+
+def export_consent(
+    root, output, fmt="jsonl", checkpoint=None, chunk_size=1000, progress=None
+):
+    """ Write consent of all users to the file output, gzip compressed.
+
+        If checkpoint is a path and an earlier export was interrupted, anything
+        written after the last complete chunk is discarded and the export
+        continues after the last exported userid.
+        The connection cache is cleared after each chunk, so memory use doesn't
+        grow with the number of users.
+        progress is called with the checkpoint values after each chunk.
+        Returns the checkpoint values.
+    """
+    conn = root._p_jar
+    state = checkpoint and _read_checkpoint(checkpoint) or None
+    if state is None or not os.path.exists(output):
+        state = {"last_userid": None, "users": 0, "rows": 0, "size": 0, "done": False}
+        with open(output, "wb"):
+            pass
+    if state["done"]:
+        return state
+    tos_info = tos_catalog_info(root)
+    users = root["users"]
+    userids = sorted(users.keys())
+    start = 0
+    if state["last_userid"] is not None:
+        start = bisect_right(userids, state["last_userid"])
+    with open(output, "r+b") as f:
+        # Anything after the last checkpoint belongs to an unfinished chunk
+        f.truncate(state["size"])
+        f.seek(state["size"])
+        for i in range(start, len(userids), chunk_size):
+            chunk = userids[i:i + chunk_size]
+            rows = []
+            for userid in chunk:
+                rows.extend(user_consent_rows(users[userid], tos_info))
+            lines = encode_rows(rows, fmt, CONSENT_FIELDNAMES)
+            if fmt == "csv" and state["size"]:
+                next(lines)  # Header only once
+            with gzip.GzipFile(fileobj=f, mode="wb") as member:
+                for line in lines:
+                    member.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            state["last_userid"] = chunk[-1]
+            state["users"] += len(chunk)
+            state["rows"] += len(rows)
+            state["size"] = f.tell()
+            if checkpoint:
+                _write_checkpoint(checkpoint, state)
+            if progress is not None:
+                progress(state)
+            conn.cacheMinimize()
+    state["done"] = True
+    if checkpoint:
+        _write_checkpoint(checkpoint, state)
+    return state
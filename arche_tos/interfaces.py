@@ -29,3 +29,25 @@ class ITOSSettings(IDict):
 
 class IImportantAgreementsRevoked(Interface):
     pass
+
+
+class IBulkAgreementsRevoked(Interface):
+    pass
+
+
+class INotificationQueue(Interface):
+    """ Queue for consent manager notifications. """
+
+
+class IEnforcementState(Interface):
+    """ Per user state of the TOS check, see arche_tos.state """
+
+    def get(userid):
+        """ Dict with check_again_at, grace_expires and digest, if they're set. """
+
+    def update(userid, values):
+        """ Set the keys in values. None removes a key. """
+
+
+class IStatsSink(Interface):
+    """ Receives counters and timings, see arche_tos.stats """
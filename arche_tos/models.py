@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from datetime import timedelta
+from hashlib import sha1
+from itertools import islice
 from logging import getLogger
 
 from arche.interfaces import IArcheFolder
@@ -12,17 +14,32 @@ from arche.utils import AttributeAnnotations
 from arche.utils import utcnow
 from pyramid.decorator import reify
 from pyramid.interfaces import IRequest
-from pyramid.renderers import render
+from pyramid.settings import asbool
+from repoze.catalog.query import Any
 from repoze.catalog.query import Eq
 from zope.component import adapter
 from zope.interface import implementer
 
+from arche_tos.cache import active_tos_cache
+from arche_tos.cache import consent_managers_cache
+from arche_tos.compact import CompactAgreedTOS
+from arche_tos.compact import CompactRevokedTOS
+from arche_tos.consent_index import get_consent_index
+from arche_tos.consent_index import get_consent_index_for
+from arche_tos.consent_log import log_consent
 from arche_tos.events import ImportantAgreementsRevoked
 from arche_tos.exceptions import TermsNeedAcceptance
 from arche_tos.exceptions import TermsNotAccepted
 from arche_tos.fanstatic_lib import terms_modal
+from arche_tos.notifications import enqueue_revoked_notice
+from arche_tos.notifications import render_for_recipients
+from arche_tos.resource import split_consent_key
+from arche_tos.state import SessionState
+from arche_tos.stats import timed
 from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import IEnforcementState
 from arche_tos.interfaces import IImportantAgreementsRevoked
+from arche_tos.interfaces import INotificationQueue
 from arche_tos.interfaces import IRevokedTOS
 from arche_tos.interfaces import ITOS
 from arche_tos.interfaces import ITOSManager
@@ -43,93 +60,261 @@ class TOSManager(object):
 
     grace_seconds = 60 * 10
     check_interval = 60 * 60
+    rollout_seconds = 0
     logger = logger  # Testing injection
 
     def __init__(self, request):
         self.request = request
 
+    @timed("check_terms")
     def check_terms(self):
-        if self.needs_check():
+        if not self.needs_check():
+            self.request.tos_stats.incr("check_skipped")
+        else:
+            self.request.tos_stats.incr("check_performed")
             # Skip check for admins
             if not self.request.has_permission(PERM_MANAGE_SYSTEM, self.request.root):
                 # Find TOS that needs to be accepted
-                for tos in self.find_tos():
-                    if tos.uid not in self.agreed_tos:
-                        self.logger.debug("Terms need acceptance: %s", tos)
-                        self.check_grace_period()
-                        raise TermsNeedAcceptance(
-                            "TOS UID need acceptance: %s" % tos.uid
-                        )
+                if self.pending_uids:
+                    uids = ", ".join(sorted(self.pending_uids))
+                    self.logger.debug("Terms need acceptance: %s", uids)
+                    self.check_grace_period()
+                    raise TermsNeedAcceptance("TOS UID need acceptance: %s" % uids)
             self.mark_checked()
 
     def needs_check(self):
-        try:
-            return self.request.session["tos_check_again_at"] < utcnow()
-        except KeyError:
-            pass
+        """ Skip checks while the active TOS are the same as the last time
+            the user passed a check, and the check interval hasn't passed.
+            Doesn't touch the profile or the catalog in that case.
+        """
+        state = self.check_state
+        if state.get("digest", None) == self.active_tos_digest():
+            try:
+                return state["check_again_at"] < utcnow()
+            except KeyError:
+                pass
         if self.agreed_tos is not None:
             return True
 
+    @reify
+    def enforcement_state(self):
+        """ The IEnforcementState utility if one is configured, otherwise the session. """
+        state = self.request.registry.queryUtility(IEnforcementState)
+        if state is None:
+            state = SessionState(self.request)
+        return state
+
+    @reify
+    def check_state(self):
+        """ Check state of the current user, read once per request. """
+        return self.enforcement_state.get(self.request.authenticated_userid)
+
+    def _update_state(self, **values):
+        for k, value in values.items():
+            if value is None:
+                self.check_state.pop(k, None)
+            else:
+                self.check_state[k] = value
+        self.enforcement_state.update(self.request.authenticated_userid, values)
+
     def mark_checked(self):
-        self.request.session["tos_check_again_at"] = utcnow() + timedelta(
-            seconds=self.check_interval
+        self._update_state(
+            check_again_at=utcnow() + timedelta(seconds=self.check_interval),
+            digest=self.active_tos_digest(),
         )
-        self.request.session.changed()
         self.logger.debug("%s mark terms checked", self.request.authenticated_userid)
 
     def check_grace_period(self):
-        sess = self.request.session
-        if "tos_grace_period_expires" not in self.request.session:
+        expires = self.check_state.get("grace_expires", None)
+        if expires is None:
             self.logger.debug(
                 "%s started grace period of %s seconds",
                 self.request.authenticated_userid,
                 self.grace_seconds,
             )
-            sess["tos_grace_period_expires"] = utcnow() + timedelta(
-                seconds=self.grace_seconds
-            )
-        if utcnow() > sess["tos_grace_period_expires"]:
+            expires = utcnow() + timedelta(seconds=self.grace_seconds)
+            self._update_state(grace_expires=expires)
+        if utcnow() > expires:
+            # Start over after the next login, like a new session would
+            self.clear_state()
             raise TermsNotAccepted()
 
     def clear_grace_period(self):
-        if "tos_grace_period_expires" in self.request.session:
-            del self.request.session["tos_grace_period_expires"]
-            self.request.session.changed()
+        if "grace_expires" in self.check_state:
+            self._update_state(grace_expires=None)
 
     def clear_checked(self):
-        if "tos_check_again_at" in self.request.session:
-            del self.request.session["tos_check_again_at"]
-            self.request.session.changed()
+        if "check_again_at" in self.check_state or "digest" in self.check_state:
+            self._update_state(check_again_at=None, digest=None)
+
+    def clear_state(self):
+        """ Forget everything stored for the current user. """
+        if self.check_state:
+            self._update_state(check_again_at=None, grace_expires=None, digest=None)
+
+    @reify
+    def active_tos_snapshot(self):
+        return active_tos_cache.get(self.request, self.request.localizer.locale_name)
+
+    def rollout_offset(self):
+        """ Seconds after effective_from the current user will see new terms.
+            Spread evenly over rollout_seconds by a hash of the userid.
+        """
+        userid = self.request.authenticated_userid
+        if not self.rollout_seconds or not userid:
+            return 0
+        return int(sha1(userid.encode("utf-8")).hexdigest()[:8], 16) % self.rollout_seconds
+
+    @reify
+    def schedule_time(self):
+        """ (now, started_at) for the time dependent parts of the snapshot. """
+        now = utcnow()
+        return now, now - timedelta(seconds=self.rollout_offset())
+
+    def active_tos_info(self):
+        """ Cached information about enabled TOS relevant for the current language.
+            Doesn't load any objects or query the catalog unless TOS changed.
+        """
+        return self.active_tos_snapshot.for_locale(
+            self.request.localizer.locale_name, *self.schedule_time
+        )
+
+    def active_tos_digest(self):
+        return self.active_tos_snapshot.digest(
+            self.request.localizer.locale_name, *self.schedule_time
+        )
+
+    @property
+    def active_uids(self):
+        return self.active_tos_snapshot.uids(
+            self.request.localizer.locale_name, *self.schedule_time
+        )
+
+    @property
+    def active_consent_keys(self):
+        return self.active_tos_snapshot.consent_keys(
+            self.request.localizer.locale_name, *self.schedule_time
+        )
+
+    @reify
+    def pending_uids(self):
+        """ frozenset of active uids the current user hasn't agreed to,
+            or only agreed to an earlier consent version of.
+            Computed once per request, agree_to and revoke_agreement reset it.
+        """
+        missing = self.agreed_tos.missing(self.active_consent_keys)
+        return frozenset(split_consent_key(x)[0] for x in missing)
+
+    def agreed_keys(self, uid):
+        """ Keys of any consent version of uid the current user agreed to. """
+        return [x for x in self.agreed_tos if split_consent_key(x)[0] == uid]
+
+    def _reset_pending(self):
+        self.__dict__.pop("pending_uids", None)
 
+    def pending_tos_info(self):
+        """ Cached information about active TOS the current user hasn't agreed to. """
+        pending = self.pending_uids
+        return [x for x in self.active_tos_info() if x.uid in pending]
+
+    @timed("find_tos")
     def find_tos(self, filter_agreed=True):
-        query = Eq("type_name", "TOS") & Eq("wf_state", "enabled")
+        if filter_agreed:
+            infos = self.pending_tos_info()
+        else:
+            infos = self.active_tos_info()
+        return self.resolve_tos_info(infos)
+
+    def resolve_tos_info(self, infos):
+        """ Load the TOS objects from cached information. """
+        self.request.tos_stats.incr("docids_resolved", len(infos))
+        return self.request.resolve_docids([x.docid for x in infos], perm=None)
+
+    @timed("resolve_tos_uids")
+    def resolve_tos_uids(self, uids):
+        """ Dict with uid as key and TOS as value, with one catalog query for all uids.
+            Uids of TOS that no longer exist are left out without loading anything.
+        """
+        uids = list(uids)
+        if not uids:
+            return {}
+        query = Eq("type_name", "TOS") & Any("uid", uids)
         docids = self.request.root.catalog.query(query)[1]
-        for tos in self.request.resolve_docids(docids, perm=None):
-            # The language aspect
-            if tos.lang and tos.lang != self.request.localizer.locale_name:
-                continue
-            if filter_agreed:
-                if tos.uid not in self.agreed_tos:
-                    yield tos
-            else:
-                yield tos
+        docids = tuple(docids)
+        self.request.tos_stats.incr("docids_resolved", len(docids))
+        return dict([(x.uid, x) for x in self.request.resolve_docids(docids, perm=None)])
+
+    @reify
+    def enabled_uids(self):
+        """ frozenset of all enabled TOS uids within their effective time,
+            regardless of language.
+        """
+        snapshot = active_tos_cache.get(self.request)
+        return frozenset(x.uid for x in snapshot.current(*self.schedule_time))
+
+    def make_agree_token(self, infos):
+        """ A token with the uid and revision of each TOS the user was shown.
+            It isn't signed. Tampering with it can't get anyone past
+            verify_agree_token, since that only accepts the current revision of
+            active terms, and requires every pending TOS.
+        """
+        return ",".join("%s:%s" % (x.uid, x.revision) for x in infos)
 
+    def verify_agree_token(self, token):
+        """ Returns the cached information about the TOS in the token.
+            Raises ValueError if any of the terms changed or if other terms
+            need acceptance too.
+            Doesn't query the catalog or load any TOS.
+        """
+        shown = {}
+        for item in filter(None, token.split(",")):
+            uid, _sep, revision = item.rpartition(":")
+            shown[uid] = int(revision)
+        found = []
+        for info in self.active_tos_info():
+            if info.uid in shown:
+                if shown.pop(info.uid) != info.revision:
+                    raise ValueError("TOS %s changed" % info.uid)
+                found.append(info)
+            elif info.uid in self.pending_uids:
+                raise ValueError("TOS %s wasn't shown" % info.uid)
+        if shown:
+            raise ValueError("TOS no longer active: %s" % ", ".join(shown))
+        return found
+
+    @timed("agree_to")
     def agree_to(self, seq):
+        """ seq is TOS objects or anything else with an uid and consent_key,
+            like the cached information.
+        """
+        userid = self.request.profile.userid
         for tos in seq:
-            self.agreed_tos.accept_tos(tos.uid)
+            # Earlier versions are replaced
+            for key in self.agreed_keys(tos.uid):
+                if key != tos.consent_key:
+                    del self.agreed_tos[key]
+            self.agreed_tos.accept_tos(tos.consent_key)
             if tos.uid in self.revoked_tos:
                 del self.revoked_tos[tos.uid]
+            log_consent(self.request.root, userid, tos.uid, "agree", tos.revision)
+        self._reset_pending()
         self.clear_grace_period()
 
+    @timed("revoke_agreement")
     def revoke_agreement(self, tos):
-        active_tos = frozenset(self.find_tos(filter_agreed=False))
         important_revoked = []
-        if tos.uid in self.agreed_tos:
-            if tos in active_tos:
+        keys = self.agreed_keys(tos.uid)
+        if keys:
+            if tos.uid in self.active_uids:
                 important_revoked.append(tos)
                 # No need to save revoke for inactive terms, so only here
                 self.revoked_tos.revoke_tos(tos.uid)
-            del self.agreed_tos[tos.uid]
+            for key in keys:
+                del self.agreed_tos[key]
+            log_consent(
+                self.request.root, self.request.profile.userid, tos.uid, "revoke", tos.revision
+            )
+            self._reset_pending()
         if important_revoked:
             self.send_revoked_event(important_revoked)
         return important_revoked
@@ -151,73 +336,120 @@ class TOSManager(object):
         )
         self.request.registry.notify(event)
 
-    def get_all_revoked_users(self, filter_tos_uids=None):
-        """ A very slow and tedious call.
-            Returns a generator that yields a user and a dict with uids as key and date revoked as value
+    @timed("get_all_revoked_users")
+    def get_all_revoked_users(self, filter_tos_uids=None, offset=0, limit=None):
+        """ Returns a generator that yields a user and a dict with uids as key and date revoked as value.
+            Uses the consent index, so only users who've revoked something will be loaded.
+            Users are sorted on userid, use offset and limit to page the result.
+        """
+        return self._get_users("revoked", filter_tos_uids, offset, limit)
+
+    def get_all_agreed_users(self, filter_tos_uids=None, offset=0, limit=None):
+        """ Returns a generator that yields a user and a dict with uids as key and date agreed as value.
+            Same as get_all_revoked_users, but for agreements.
         """
+        return self._get_users("agreed", filter_tos_uids, offset, limit)
+
+    def _get_users(self, kind, filter_tos_uids=None, offset=0, limit=None):
+        index = get_consent_index(self.request.root, create=False)
+        if index is None or not index.built:
+            self.logger.warning(
+                "Consent index isn't built, falling back to checking all users. "
+                "Run arche_tos_rebuild_index to fix this."
+            )
+            stop = limit is not None and offset + limit or None
+            return islice(self._scan_users(kind, filter_tos_uids), offset, stop)
+        return self._get_indexed_users(index, kind, filter_tos_uids, offset, limit)
+
+    def _get_indexed_users(self, index, kind, filter_tos_uids=None, offset=0, limit=None):
+        found = index.collect(kind, filter_tos_uids)
+        users = self.request.root["users"]
+        userids = sorted(found)
+        if limit is None:
+            userids = userids[offset:]
+        else:
+            userids = userids[offset : offset + limit]
+        for userid in userids:
+            user = users.get(userid, None)
+            if user is not None:
+                yield user, found[userid]
+
+    def _scan_users(self, kind, filter_tos_uids=None):
+        """ A very slow and tedious call, only used when there's no consent index. """
+        storage_iface = kind == "agreed" and IAgreedTOS or IRevokedTOS
         if filter_tos_uids:
             filter_tos_uids = frozenset(filter_tos_uids)
         for user in self.request.root["users"].values():
-            revoked_tos = IRevokedTOS(user)
-            revoked_uids = frozenset(revoked_tos.keys())
-            if revoked_uids:
-                if filter_tos_uids:
-                    relevant_revoked = filter_tos_uids & revoked_uids
-                    if relevant_revoked:
-                        yield user, dict(
-                            [
-                                (k, v)
-                                for k, v in revoked_tos.items()
-                                if k in relevant_revoked
-                            ]
-                        )
-                else:
-                    yield user, dict([(k, v) for k, v in revoked_tos.items()])
+            # Agreements to any consent version count
+            found = dict(
+                (split_consent_key(k)[0], v) for k, v in storage_iface(user).items()
+            )
+            if filter_tos_uids:
+                found = dict((k, v) for k, v in found.items() if k in filter_tos_uids)
+            if found:
+                yield user, found
 
     def get_consent_managers(self):
-        settings = ITOSSettings(self.request.root)
+        """ Users set as consent managers that have an email address. """
         users = self.request.root["users"]
-        for userid in settings.get("data_consent_managers", ()):
-            try:
-                user = users[userid]
-            except KeyError:
-                logger.warning(
-                    "Set data consent manager userid '%s' doesn't exist.", userid
-                )
-                continue
-            if user.email:
+        for info in consent_managers_cache.get(self.request):
+            user = users.get(info.userid, None)
+            if user is not None:
                 yield user
-            else:
-                logger.warning(
-                    "Set data consent manager userid '%s' doesn't have a valid email address.",
-                    userid,
-                )
+
+
+class IndexedConsentAnnotations(AttributeAnnotations):
+    """ Keeps the consent index in sync with the users own storage. """
+
+    index_kind = None
+
+    def __setitem__(self, key, value):
+        AttributeAnnotations.__setitem__(self, key, value)
+        index = get_consent_index_for(self.context)
+        if index is not None:
+            index.add(self.index_kind, key, self.context.userid, value)
+
+    def __delitem__(self, key):
+        AttributeAnnotations.__delitem__(self, key)
+        index = get_consent_index_for(self.context)
+        if index is not None:
+            index.remove(self.index_kind, key, self.context.userid)
+
+    def missing(self, uids):
+        """ frozenset of uids that aren't keys here. """
+        return frozenset(uids) - frozenset(self.data.keys())
 
 
 @adapter(IUser)
 @implementer(IAgreedTOS)
-class AgreedTOS(AttributeAnnotations):
+class AgreedTOS(IndexedConsentAnnotations):
     """ Handles a named storage for keys/values.
         UID of agreed terms will be key, and value will be a date.
     """
 
     attr_name = "_agreed_tos"
+    index_kind = "agreed"
 
-    def accept_tos(self, uid):
-        self[uid] = utcnow().date()
+    def accept_tos(self, uid, date=None):
+        if date is None:
+            date = utcnow().date()
+        self[uid] = date
 
 
 @adapter(IUser)
 @implementer(IRevokedTOS)
-class RevokedTOS(AttributeAnnotations):
+class RevokedTOS(IndexedConsentAnnotations):
     """ Handles a named storage for keys/values.
         UID of revoked terms will be key, and value will be a date.
     """
 
     attr_name = "_revoked_tos"
+    index_kind = "revoked"
 
-    def revoke_tos(self, uid):
-        self[uid] = utcnow().date()
+    def revoke_tos(self, uid, date=None):
+        if date is None:
+            date = utcnow().date()
+        self[uid] = date
 
 
 @adapter(IRoot)
@@ -241,6 +473,7 @@ def check_terms(view, event):
     # Don't mix accept terms popups with other TOS functionality
     if getattr(request, "view_name", "") in (
         "tos_form",
+        "tos_pending.json",
         "revoke_agreement",
         "agreed_tos",
     ):
@@ -254,29 +487,43 @@ def check_terms(view, event):
         return
 
 
+@timed("email_data_consent_managers")
 def email_data_consent_managers(event):
     request = event.request
     root = request.root
     settings = ITOSSettings(root)
     if settings.get("email_consent_managers", None):
-        tos_manager = ITOSManager(request)
-        for user in tos_manager.get_consent_managers():
-            values = {
-                "revoked_user": event.user,
-                "revoked_tos": event.revoked_tos,
-                "user": user,
-                "site_title": root.title,
-                "tos_link": request.resource_url(root, "_manage_tos"),
-            }
-            html = render(
-                "arche_tos:templates/email_revoked_consent.pt", values, request
-            )
-            subject = _(
-                "revoked_consent_subject",
-                default="Revoked consent notice from ${title}",
-                mapping={"title": root.title},
-            )
-            request.send_email(subject, [user.email], html)
+        queue = request.registry.queryUtility(INotificationQueue)
+        if queue is not None:
+            # Sent later as a digest by the notification worker
+            return enqueue_revoked_notice(queue, event)
+        tos_link = request.resource_url(root, "_manage_tos")
+        values = {
+            "revoked_tos": event.revoked_tos,
+            "site_title": root.title,
+            "tos_link": tos_link,
+        }
+        # The body only depends on the terms, so a withdrawn TOS renders it once
+        cache_key = (
+            "email_revoked_consent",
+            request.locale_name,
+            root.title,
+            tos_link,
+            tuple((x.uid, x.revision) for x in event.revoked_tos),
+        )
+        subject = _(
+            "revoked_consent_subject",
+            default="Revoked consent notice from ${title}",
+            mapping={"title": root.title},
+        )
+        for manager, html in render_for_recipients(
+            request,
+            "arche_tos:templates/email_revoked_consent.pt",
+            values,
+            consent_managers_cache.get(request),
+            cache_key=cache_key,
+        ):
+            request.send_email(subject, [manager.email], html)
 
 
 def protect_enabled_tos(request, context):
@@ -302,17 +549,25 @@ def includeme(config):
     arche_tos.grace_seconds = <int>
     # Number of seconds to wait between each check
     arche_tos.check_interval = <int>
+    # Spread when users see TOS with effective_from over this many seconds
+    arche_tos.rollout_seconds = <int>
+    # Store consent on users in compact records, see arche_tos.compact
+    arche_tos.compact_consent = <bool>
     """
     settings = config.registry.settings
     prefix = "arche_tos.%s"
-    for k in ("grace_seconds", "check_interval"):
+    for k in ("grace_seconds", "check_interval", "rollout_seconds"):
         key = prefix % k
         if key in settings:
             val = int(settings[key])
             setattr(TOSManager, k, val)
     config.registry.registerAdapter(TOSManager)
-    config.registry.registerAdapter(AgreedTOS)
-    config.registry.registerAdapter(RevokedTOS)
+    if asbool(settings.get("arche_tos.compact_consent", False)):
+        config.registry.registerAdapter(CompactAgreedTOS)
+        config.registry.registerAdapter(CompactRevokedTOS)
+    else:
+        config.registry.registerAdapter(AgreedTOS)
+        config.registry.registerAdapter(RevokedTOS)
     config.registry.registerAdapter(TOSSettings)
     config.add_subscriber(check_terms, [IBaseView, IViewInitializedEvent])
     config.add_subscriber(email_data_consent_managers, IImportantAgreementsRevoked)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+""" Queued notifications to data consent managers.
+
+    If arche_tos.notification_queue is set to a file path, revoked consent
+    won't cause any emails during the request. A small record is stored in a
+    SQLite queue when the transaction commits instead, and the worker started by
+    the console script arche_tos_notify sends one digest per consent manager
+    every arche_tos.notification_flush_interval seconds.
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from html import escape
+from logging import getLogger
+from uuid import uuid4
+
+import transaction
+from arche.utils import utcnow
+from pyramid.renderers import render
+from zope.interface import implementer
+
+from arche_tos import _
+from arche_tos.cache import consent_managers_cache
+from arche_tos.cache import email_body_cache
+from arche_tos.interfaces import IBulkAgreementsRevoked
+from arche_tos.interfaces import INotificationQueue
+from arche_tos.interfaces import ITOSSettings
+
+logger = getLogger(__name__)
+
+# Rendered in place of the recipients title, and replaced for each recipient
+RECIPIENT_TITLE = "__arche_tos_recipient_title__"
+
+
+@implementer(INotificationQueue)
+class NotificationQueue(object):
+    """ SQLite backed queue. Safe to use from several processes.
+        Records are claimed before they're processed and removed with ack
+        once the digest is sent, or released to be retried later.
+    """
+
+    def __init__(self, path, stale_seconds=60 * 60):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS revoked_notices ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "userid TEXT NOT NULL, "
+                "user_title TEXT NOT NULL, "
+                "tos_uids TEXT NOT NULL, "
+                "created TEXT NOT NULL, "
+                "claim TEXT, "
+                "claimed_at REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def put(self, userid, user_title, tos_uids, created=None):
+        if created is None:
+            created = utcnow()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO revoked_notices (userid, user_title, tos_uids, created) "
+                "VALUES (?, ?, ?, ?)",
+                (userid, user_title, json.dumps(list(tos_uids)), created.isoformat()),
+            )
+
+    def claim(self, limit=None):
+        """ Returns a claim token and a list of records as dicts.
+            Claims older than stale_seconds are considered abandoned and will be claimed again.
+        """
+        token = uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE revoked_notices SET claim = ?, claimed_at = ? "
+                "WHERE id IN (SELECT id FROM revoked_notices "
+                "WHERE claim IS NULL OR claimed_at < ? ORDER BY id LIMIT ?)",
+                (token, now, now - self.stale_seconds, limit is None and -1 or limit),
+            )
+            rows = conn.execute(
+                "SELECT userid, user_title, tos_uids, created FROM revoked_notices "
+                "WHERE claim = ? ORDER BY id",
+                (token,),
+            ).fetchall()
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        records = [
+            {
+                "userid": userid,
+                "user_title": user_title,
+                "tos_uids": json.loads(tos_uids),
+                "created": created,
+            }
+            for (userid, user_title, tos_uids, created) in rows
+        ]
+        return token, records
+
+    def ack(self, token):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM revoked_notices WHERE claim = ?", (token,))
+
+    def release(self, token):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE revoked_notices SET claim = NULL, claimed_at = NULL WHERE claim = ?",
+                (token,),
+            )
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM revoked_notices").fetchone()[0]
+
+
+def _enqueue_after_commit(queue, notices):
+    """ Store notices when the transaction commits, so aborted revokes won't notify anyone.
+        notices is a list of (userid, user_title, tos_uids).
+    """
+
+    def _hook(success):
+        if success:
+            for notice in notices:
+                queue.put(*notice)
+
+    transaction.get().addAfterCommitHook(_hook)
+
+
+def enqueue_revoked_notice(queue, event):
+    """ For ImportantAgreementsRevoked events. """
+    notices = [(event.user.userid, event.user.title, [x.uid for x in event.revoked_tos])]
+    _enqueue_after_commit(queue, notices)
+
+
+def revoked_records(request, revoked):
+    """ Convert the revoked dict of a BulkAgreementsRevoked event to records
+        like the ones stored in the queue.
+    """
+    users = request.root["users"]
+    created = utcnow().isoformat()
+    records = []
+    for userid, tos_list in sorted(revoked.items()):
+        if not tos_list:
+            continue
+        user = users.get(userid, None)
+        records.append(
+            {
+                "userid": userid,
+                "user_title": user is not None and user.title or userid,
+                "tos_uids": [x.uid for x in tos_list],
+                "created": created,
+            }
+        )
+    return records
+
+
+def notify_bulk_revoked(event):
+    """ Queue or send one digest for all revocations in a bulk operation. """
+    request = event.request
+    settings = ITOSSettings(request.root)
+    if not settings.get("email_consent_managers", None):
+        return
+    records = revoked_records(request, event.revoked)
+    if not records:
+        return
+    queue = request.registry.queryUtility(INotificationQueue)
+    if queue is not None:
+        notices = [(x["userid"], x["user_title"], x["tos_uids"]) for x in records]
+        return _enqueue_after_commit(queue, notices)
+    send_digests(request, records)
+
+
+def send_digests(request, records):
+    """ Send one email per consent manager with all records.
+        Returns the number of emails sent.
+    """
+    root = request.root
+    settings = ITOSSettings(root)
+    if not settings.get("email_consent_managers", None):
+        return 0
+    tos_titles = {}
+    for record in records:
+        for uid in record["tos_uids"]:
+            if uid not in tos_titles:
+                tos = request.resolve_uid(uid, perm=None)
+                tos_titles[uid] = tos is not None and tos.title or uid
+    revoked = [
+        (record, [tos_titles[x] for x in record["tos_uids"]]) for record in records
+    ]
+    subject = _(
+        "revoked_consent_digest_subject",
+        default="Revoked consent notices from ${title}",
+        mapping={"title": root.title},
+    )
+    values = {
+        "revoked": revoked,
+        "site_title": root.title,
+        "tos_link": request.resource_url(root, "_manage_tos"),
+    }
+    sent = 0
+    for manager, html in render_for_recipients(
+        request,
+        "arche_tos:templates/email_revoked_consent_digest.pt",
+        values,
+        consent_managers_cache.get(request),
+    ):
+        request.send_email(subject, [manager.email], html)
+        sent += 1
+    return sent
+
+
+def render_for_recipients(request, renderer_name, values, recipients, cache_key=None):
+    """ Render a template once and yield (recipient, html) for each recipient.
+        The template gets recipient_title as a placeholder, which is replaced
+        with the escaped title of each recipient.
+        If cache_key is given, the rendered template is kept between calls.
+    """
+    if not recipients:
+        return
+    html = None
+    if cache_key is not None:
+        html = email_body_cache.get(cache_key)
+    if html is None:
+        values = dict(values, recipient_title=RECIPIENT_TITLE)
+        html = render(renderer_name, values, request)
+        if cache_key is not None:
+            email_body_cache.set(cache_key, html)
+    for recipient in recipients:
+        yield recipient, html.replace(RECIPIENT_TITLE, escape(recipient.title or ""))
+
+
+def flush_queue(env, queue, limit=None):
+    """ Process everything in the queue within a pyramid environment,
+        like the one returned by pyramid.paster.bootstrap.
+    """
+    token, records = queue.claim(limit)
+    if not records:
+        return 0
+    try:
+        sent = send_digests(env["request"], records)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        queue.release(token)
+        raise
+    queue.ack(token)
+    logger.info("Sent %s digests about %s revoked notices", sent, len(records))
+    return len(records)
+
+
+class NotificationWorker(object):
+    """ Flush the queue every interval seconds. env_factory should return
+        a fresh pyramid environment with a closer.
+    """
+
+    def __init__(self, env_factory, queue, interval):
+        self.env_factory = env_factory
+        self.queue = queue
+        self.interval = interval
+        self.running = False
+
+    def run_once(self):
+        env = self.env_factory()
+        try:
+            return flush_queue(env, self.queue)
+        finally:
+            env["closer"]()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Failed to send consent manager notifications")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+
+
+def includeme(config):
+    """
+    arche_tos.notification_queue = <path to sqlite file>
+    arche_tos.notification_flush_interval = <int, seconds>
+    """
+    settings = config.registry.settings
+    path = settings.get("arche_tos.notification_queue", None)
+    if path:
+        config.registry.registerUtility(NotificationQueue(path), INotificationQueue)
+    config.add_subscriber(notify_bulk_revoked, IBulkAgreementsRevoked)
@@ -1,13 +1,64 @@
 # -*- coding: utf-8 -*-
 from arche.utils import utcnow
+from persistent import Persistent
 from zope.interface import implementer
 from arche.resources import Content
 from arche.resources import ContextACLMixin
+from pyramid.traversal import find_resource
+from repoze.catalog.indexes.field import CatalogFieldIndex
+from repoze.catalog.query import Eq
 
 from arche_tos.interfaces import ITOS
 from arche_tos import _
 
 
+class TOSText(Persistent):
+    """ Rich text kept in its own record, so the TOS can be loaded without it. """
+
+    def __init__(self, text=""):
+        self.text = text
+
+
+def text_property(name):
+    """ Stores the text in a TOSText, and reads text stored on the object itself
+        by older versions. It's moved the next time it's set.
+    """
+    attr = "_%s_text" % name
+
+    def _get(self):
+        text = getattr(self, attr, None)
+        if text is not None:
+            return text.text
+        return self.__dict__.get(name, "")
+
+    def _set(self, value):
+        text = getattr(self, attr, None)
+        if text is None:
+            setattr(self, attr, TOSText(value))
+        elif text.text != value:
+            text.text = value
+        if name in self.__dict__:
+            del self.__dict__[name]
+            self._p_changed = True
+
+    return property(_get, _set)
+
+
+def consent_key(uid, consent_version):
+    """ Key agreements are stored with. The first version is stored with the uid,
+        so agreements from before versions existed are still valid.
+    """
+    if consent_version:
+        return "%s@%s" % (uid, consent_version)
+    return uid
+
+
+def split_consent_key(key):
+    """ Returns (uid, consent_version). """
+    uid, sep, version = key.partition("@")
+    return uid, sep and int(version) or 0
+
+
 @implementer(ITOS)
 class TOS(Content, ContextACLMixin):
     type_name = "TOS"
@@ -17,18 +68,63 @@ class TOS(Content, ContextACLMixin):
     listing_visible = True
     search_visible = False
     title = ""
-    body = ""
+    body = text_property("body")
     collapse_text = False
-    revoke_body = ""
+    revoke_body = text_property("revoke_body")
     lang = ""
     check_password_on_revoke = False
     check_typed_on_revoke = False
+    revision = 0
+    consent_version = 0
+    effective_from = None
+    expires_at = None
 
     @property
     def is_active(self):
         return self.wf_state == "enabled"
 
+    @property
+    def consent_key(self):
+        return consent_key(self.uid, self.consent_version)
+
+    @property
+    def require_new_consent(self):
+        """ Set to True to make everyone agree again. """
+        return False
+
+    @require_new_consent.setter
+    def require_new_consent(self, value):
+        if value:
+            self.consent_version += 1
+
+
+def get_lang(context, default):
+    if ITOS.providedBy(context):
+        return context.lang
+    return default
+
+
+def reindex_lang(root):
+    """ Add the lang index if it's missing and index all TOS. """
+    catalog = root.catalog
+    if 'lang' not in catalog:
+        catalog['lang'] = CatalogFieldIndex(get_lang)
+    index = catalog['lang']
+    for docid in catalog.query(Eq('type_name', 'TOS'))[1]:
+        path = root.document_map.address_for_docid(docid)
+        index.index_doc(docid, find_resource(root, path))
+
+
+def move_tos_texts(root):
+    """ Move body and revoke_body of existing TOS to their own records. """
+    for docid in root.catalog.query(Eq('type_name', 'TOS'))[1]:
+        path = root.document_map.address_for_docid(docid)
+        tos = find_resource(root, path)
+        tos.body = tos.body
+        tos.revoke_body = tos.revoke_body
+
 
 def includeme(config):
     config.add_content_factory(TOS, addable_to='Folder')
     config.set_content_workflow('TOS', 'activate_workflow')
+    config.add_catalog_indexes(__name__, {'lang': CatalogFieldIndex(get_lang)})
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+""" Offline consent scan of all users, split over several processes.
+
+    The userids are split into ranges, and each range is scanned by a worker
+    process with its own read-only connection to the FileStorage. The partial
+    results are merged as they come in:
+
+        arche_tos_scan var/Data.fs --workers 8 --revoked --pending > scan.json
+
+    Nothing is written to the database. Reading a FileStorage while another
+    process appends to it isn't supported, so run it against a copy of
+    Data.fs, for instance a backup.
+
+    Users language isn't stored, so pending is only computed for TOS without
+    lang set.
+"""
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from arche.utils import utcnow
+from pyramid.traversal import find_resource
+from repoze.catalog.query import Eq
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from arche_tos.compact import CompactAgreedTOS
+from arche_tos.compact import CompactRevokedTOS
+
+
+class ScanResult(object):
+    """ Agreed and pending counts per consent key, revoked counts per TOS uid,
+        and optionally revoked and pending per userid.
+    """
+
+    def __init__(self):
+        self.users = 0
+        self.agreed = {}
+        self.revoked = {}
+        self.pending = {}
+        self.revoked_users = {}
+        self.pending_users = {}
+
+    def merge(self, other):
+        self.users += other.users
+        for name in ("agreed", "revoked", "pending"):
+            mine = getattr(self, name)
+            for uid, count in getattr(other, name).items():
+                mine[uid] = mine.get(uid, 0) + count
+        self.revoked_users.update(other.revoked_users)
+        self.pending_users.update(other.pending_users)
+        return self
+
+    def as_dict(self):
+        return {
+            "users": self.users,
+            "agreed": self.agreed,
+            "revoked": self.revoked,
+            "pending": self.pending,
+            "revoked_users": dict(
+                (userid, dict((k, v.isoformat()) for k, v in revoked.items()))
+                for userid, revoked in self.revoked_users.items()
+            ),
+            "pending_users": self.pending_users,
+        }
+
+
+def scan_users(users, active_keys, collect_revoked=False, collect_pending=False):
+    """ Scan an iterable of users. active_keys are the consent keys users must
+        have agreed to, see arche_tos.resource.consent_key.
+    """
+    result = ScanResult()
+    for user in users:
+        result.users += 1
+        agreed = CompactAgreedTOS(user)
+        for uid in agreed:
+            result.agreed[uid] = result.agreed.get(uid, 0) + 1
+        revoked = dict(CompactRevokedTOS(user).items())
+        for uid in revoked:
+            result.revoked[uid] = result.revoked.get(uid, 0) + 1
+        missing = agreed.missing(active_keys)
+        for uid in missing:
+            result.pending[uid] = result.pending.get(uid, 0) + 1
+        if collect_revoked and revoked:
+            result.revoked_users[user.userid] = revoked
+        if collect_pending and missing:
+            result.pending_users[user.userid] = sorted(missing)
+    return result
+
+
+def split_ranges(userids, parts):
+    """ Split sorted userids into at most parts ranges of (first, last), inclusive. """
+    if not userids:
+        return []
+    size = max(1, -(-len(userids) // parts))
+    return [
+        (userids[i], userids[min(i + size, len(userids)) - 1])
+        for i in range(0, len(userids), size)
+    ]
+
+
+def find_active_keys(root, now=None):
+    """ Consent keys of all enabled TOS within their effective time.
+        TOS for a specific language are left out, since there's no telling
+        which users they apply to.
+    """
+    if now is None:
+        now = utcnow()
+    docids = root.catalog.query(Eq("type_name", "TOS") & Eq("wf_state", "enabled"))[1]
+    found = set()
+    for docid in docids:
+        tos = find_resource(root, root.document_map.address_for_docid(docid))
+        if tos.lang:
+            continue
+        if tos.effective_from is not None and now < tos.effective_from:
+            continue
+        if tos.expires_at is not None and tos.expires_at <= now:
+            continue
+        found.add(tos.consent_key)
+    return frozenset(found)
+
+
+# Per worker process, opened by _init_worker
+_worker = {}
+
+
+def _init_worker(path, root_name):
+    db = DB(FileStorage(path, read_only=True))
+    _worker["db"] = db
+    _worker["conn"] = db.open()
+    _worker["root_name"] = root_name
+
+
+def _scan_range(args):
+    first, last, active_keys, collect_revoked, collect_pending, minimize_every = args
+    conn = _worker["conn"]
+    conn.sync()
+    users = conn.root()[_worker["root_name"]]["users"]
+
+    def _users():
+        # The users folder keeps its items in an OOBTree, so the range is a BTree lookup
+        for i, userid in enumerate(users.data.keys(min=first, max=last), 1):
+            yield users[userid]
+            if i % minimize_every == 0:
+                conn.cacheMinimize()
+
+    result = scan_users(_users(), active_keys, collect_revoked, collect_pending)
+    conn.cacheMinimize()
+    return result
+
+
+def parallel_scan(
+    path,
+    root_name="app_root",
+    workers=None,
+    active_keys=None,
+    collect_revoked=False,
+    collect_pending=False,
+    ranges_per_worker=4,
+    minimize_every=1000,
+):
+    """ Scan all users of the FileStorage at path with a pool of processes.
+        active_keys defaults to the consent keys of all enabled TOS without lang.
+        Returns a merged ScanResult.
+    """
+    db = DB(FileStorage(path, read_only=True))
+    conn = db.open()
+    try:
+        root = conn.root()[root_name]
+        if active_keys is None:
+            active_keys = find_active_keys(root)
+        userids = list(root["users"].keys())
+    finally:
+        conn.close()
+        db.close()
+    workers = workers or os.cpu_count() or 1
+    # More ranges than workers, so a slow range doesn't leave the others idle
+    ranges = split_ranges(userids, workers * ranges_per_worker)
+    del userids
+    tasks = [
+        (first, last, frozenset(active_keys), collect_revoked, collect_pending, minimize_every)
+        for first, last in ranges
+    ]
+    result = ScanResult()
+    pool = Pool(workers, initializer=_init_worker, initargs=(path, root_name))
+    try:
+        for partial in pool.imap_unordered(_scan_range, tasks):
+            result.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Count agreed, revoked and pending TOS for all users of a FileStorage."
+    )
+    parser.add_argument("filestorage", help="Path to Data.fs")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Defaults to the number of cores"
+    )
+    parser.add_argument("--root-name", default="app_root", help="Key of the Arche root")
+    parser.add_argument("--revoked", action="store_true", help="Include revoked TOS per user")
+    parser.add_argument("--pending", action="store_true", help="Include pending TOS per user")
+    args = parser.parse_args(argv)
+    result = parallel_scan(
+        args.filestorage,
+        root_name=args.root_name,
+        workers=args.workers,
+        collect_revoked=args.revoked,
+        collect_pending=args.pending,
+    )
+    json.dump(result.as_dict(), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
@@ -4,6 +4,7 @@ import deform
 from arche.schemas import default_now
 from arche.schemas import maybe_modal_form
 from arche.security import PERM_MANAGE_USERS
+from arche.security import ROLE_ADMIN
 from arche.security import principal_has_permisson
 from arche.validators import deferred_current_password_validator
 from arche.widgets import UserReferenceWidget, ReferenceWidget
@@ -16,8 +17,18 @@ def _return(value):
     return value == True  # Will be interpreted as failed check by Function method.
 
 
+@colander.deferred
+def default_agree_token(node, kw):
+    return kw["view"].agree_token
+
+
 class TOSAgreeSchema(colander.Schema):
     widget = maybe_modal_form
+    tos_token = colander.SchemaNode(
+        colander.String(),
+        widget=deform.widget.HiddenWidget(),
+        default=default_agree_token,
+    )
     agree_check = colander.SchemaNode(
         colander.Bool(),
         title=_("I've read the full agreement and I agree to it"),
@@ -151,6 +162,24 @@ class TOSSchema(colander.Schema):
         default="",
         missing="",
     )
+    effective_from = colander.SchemaNode(
+        colander.DateTime(),
+        title=_("Effective from"),
+        description=_(
+            "effective_from_description",
+            default="If set, enabled terms won't be shown to anyone before this.",
+        ),
+        missing=None,
+    )
+    expires_at = colander.SchemaNode(
+        colander.DateTime(),
+        title=_("Expires at"),
+        description=_(
+            "expires_at_description",
+            default="If set, enabled terms won't be required after this.",
+        ),
+        missing=None,
+    )
     check_password_on_revoke = colander.SchemaNode(
         colander.Bool(),
         title=_("Require password check on revoke"),
@@ -165,20 +194,45 @@ class TOSSchema(colander.Schema):
     )
 
 
+class EditTOSSchema(TOSSchema):
+    require_new_consent = colander.SchemaNode(
+        colander.Bool(),
+        title=_("Require everyone to agree again"),
+        description=_(
+            "require_new_consent_description",
+            default="Use this for changes to what users agree to. "
+            "Users who agreed to an earlier version need to agree again.",
+        ),
+        default=False,
+        missing=False,
+    )
+
+
+def is_administrator(request, root, userid):
+    """ Administrators are usually given their role directly on the root,
+        so that's checked before evaluating the security policy.
+    """
+    if ROLE_ADMIN in root.local_roles.get(userid, ()):
+        return True
+    return principal_has_permisson(request, userid, PERM_MANAGE_USERS, context=root)
+
+
 @colander.deferred
 class OnlyAdministratorsWithEmailValidator(object):
+    """ Only the submitted userids are checked, regardless of the number of users. """
+
     def __init__(self, node, kw):
         self.root = find_root(kw["context"])
         self.request = kw["request"]
 
     def __call__(self, node, value):
-        allowed_userids = set()
-        for userid in self.root.users.keys():
-            if principal_has_permisson(
-                self.request, userid, PERM_MANAGE_USERS, context=self.root
+        users = self.root["users"]
+        non_admins = []
+        for userid in sorted(value):
+            if userid not in users or not is_administrator(
+                self.request, self.root, userid
             ):
-                allowed_userids.add(userid)
-        non_admins = set(value) - allowed_userids
+                non_admins.append(userid)
         if non_admins:
             msg = _(
                 "users_arent_admins_error",
@@ -187,8 +241,8 @@ class OnlyAdministratorsWithEmailValidator(object):
                 mapping={"users": "', '".join(non_admins)},
             )
             raise colander.Invalid(node, msg)
-        for userid in allowed_userids:
-            if not self.root.users[userid].email:
+        for userid in sorted(value):
+            if not users[userid].email:
                 msg = _(
                     "user_bad_email_error",
                     default="${userid} doesn't have an email address set.",
@@ -225,5 +279,6 @@ class TOSSettingsSchema(colander.Schema):
 def includeme(config):
     config.add_schema("TOS", TOSAgreeSchema, "agree")
     config.add_schema("TOS", TOSRevokeSchema, "revoke")
-    config.add_schema("TOS", TOSSchema, ["add", "edit"])
+    config.add_schema("TOS", TOSSchema, "add")
+    config.add_schema("TOS", EditTOSSchema, "edit")
     config.add_schema("TOS", TOSSettingsSchema, "settings")
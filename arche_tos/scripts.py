@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+""" Console scripts. They all expect a paster ini file with the Arche
+    application as their first argument.
+"""
+import argparse
+import logging
+
+import transaction
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid.scripting import prepare
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from arche_tos.bulk import bulk_consent
+from arche_tos.bulk import read_rows
+from arche_tos.cache import bump_tos_generation
+from arche_tos.compact import migrate_to_compact
+from arche_tos.consent_index import rebuild_consent_index
+from arche_tos.consent_log import get_consent_log
+from arche_tos.export import export_consent
+from arche_tos.interfaces import INotificationQueue
+from arche_tos.notifications import NotificationWorker
+from arche_tos.notifications import flush_queue
+from arche_tos.resource import move_tos_texts
+from arche_tos.resource import reindex_lang
+
+
+def _bootstrap(description, parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("config_uri", help="Paster ini file to load settings from")
+    args = parser.parse_args()
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    return args, env
+
+
+def rebuild_index():
+    args, env = _bootstrap(
+        "Upgrade the data of an existing site. Indexes TOS language in the catalog, "
+        "moves TOS texts to separate records and rebuilds the index of agreed "
+        "and revoked terms. Safe to run again."
+    )
+    try:
+        reindex_lang(env["root"])
+        move_tos_texts(env["root"])
+        bump_tos_generation(env["root"])
+        index = rebuild_consent_index(env["root"])
+        transaction.commit()
+        logging.getLogger(__name__).info(
+            "Consent index rebuilt: %s agreed and %s revoked TOS",
+            len(index.agreed),
+            len(index.revoked),
+        )
+    finally:
+        env["closer"]()
+
+
+def notify():
+    parser = argparse.ArgumentParser(
+        description="Send queued notices about revoked consent to consent managers."
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Flush the queue once and exit"
+    )
+    args, env = _bootstrap(None, parser)
+    registry = env["registry"]
+    queue = registry.queryUtility(INotificationQueue)
+    if queue is None:
+        env["closer"]()
+        parser.error("arche_tos.notification_queue isn't set in the ini file")
+    if args.once:
+        try:
+            flush_queue(env, queue)
+        finally:
+            env["closer"]()
+        return
+    env["closer"]()
+    interval = int(
+        registry.settings.get("arche_tos.notification_flush_interval", 60 * 5)
+    )
+    worker = NotificationWorker(lambda: prepare(registry=registry), queue, interval)
+    worker.run()
+
+
+def bulk():
+    parser = argparse.ArgumentParser(
+        description="Agree or revoke terms for many users from a CSV or JSON-lines file "
+        "with the columns userid, tos_uid and date (optional, YYYY-MM-DD)."
+    )
+    parser.add_argument("action", choices=("agree", "revoke"))
+    parser.add_argument("filename")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Abort instead of committing"
+    )
+    args, env = _bootstrap(None, parser)
+    logger = logging.getLogger(__name__)
+    fmt = args.format
+    if fmt is None:
+        fmt = args.filename.endswith(".csv") and "csv" or "jsonl"
+
+    def _progress(result):
+        logger.info(
+            "Processed %s rows, %s changed, %s failed",
+            result.processed,
+            result.changed,
+            len(result.failed),
+        )
+
+    try:
+        with open(args.filename) as fp:
+            result = bulk_consent(
+                env["root"],
+                read_rows(fp, fmt),
+                args.action,
+                batch_size=args.batch_size,
+                request=env["request"],
+                progress=_progress,
+                commit=not args.dry_run,
+            )
+        if args.dry_run:
+            transaction.abort()
+        for userid, tos_uid, error in result.failed:
+            logger.warning("Failed %s for %s: %s", tos_uid, userid, error)
+    finally:
+        env["closer"]()
+
+
+def compact():
+    args, env = _bootstrap("Convert consent stored on users to compact records.")
+    try:
+        changed = migrate_to_compact(env["root"])
+        transaction.commit()
+        logging.getLogger(__name__).info("Converted consent for %s users", changed)
+    finally:
+        env["closer"]()
+
+
+def compact_log():
+    args, env = _bootstrap("Move consent log events from before today to daily segments.")
+    try:
+        log = get_consent_log(env["root"], create=False)
+        moved = log is not None and log.compact() or 0
+        transaction.commit()
+        logging.getLogger(__name__).info("Moved %s consent log events to segments", moved)
+    finally:
+        env["closer"]()
+
+
+def export():
+    parser = argparse.ArgumentParser(
+        description="Export consent of all users from a FileStorage, as gzipped "
+        "JSON-lines or CSV. Doesn't need a running site."
+    )
+    parser.add_argument("filestorage", help="Path to Data.fs")
+    parser.add_argument("output", help="File to write, for instance consent.jsonl.gz")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument(
+        "--checkpoint", help="Checkpoint file, to be able to resume an interrupted export"
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Users per chunk")
+    parser.add_argument("--root-name", default="app_root", help="Key of the Arche root")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    storage = FileStorage(args.filestorage, read_only=True)
+    db = DB(storage)
+    conn = db.open()
+    try:
+        root = conn.root()[args.root_name]
+        state = export_consent(
+            root,
+            args.output,
+            fmt=args.format,
+            checkpoint=args.checkpoint,
+            chunk_size=args.chunk_size,
+            progress=lambda x: logger.info("Exported %s users", x["users"]),
+        )
+        logger.info("Done, %s rows for %s users", state["rows"], state["users"])
+    finally:
+        conn.close()
+        db.close()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+""" Where the TOS check keeps track of each user.
+
+    Three values are stored per userid:
+
+    check_again_at
+        When the next full check is due.
+    grace_expires
+        When the grace period for pending terms runs out.
+    digest
+        Fingerprint of the active TOS the user passed a check for.
+
+    By default they're stored in the session like before. Set
+    arche_tos.enforcement_state to keep them out of the session and share them
+    between processes:
+
+        arche_tos.enforcement_state = memory
+        arche_tos.enforcement_state = sqlite:///path/to/state.db
+        arche_tos.enforcement_state = redis://localhost:6379/0
+
+    Redis requires the redis package.
+"""
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+from threading import Lock
+
+from zope.interface import implementer
+
+from arche_tos.interfaces import IEnforcementState
+
+KEYS = ("check_again_at", "grace_expires", "digest")
+TIME_KEYS = ("check_again_at", "grace_expires")
+
+
+def _to_timestamp(value):
+    return value.timestamp()
+
+
+def _from_timestamp(value):
+    return datetime.fromtimestamp(float(value), timezone.utc)
+
+
+class SessionState(object):
+    """ Stores everything in the users session. Used when nothing else is configured. """
+
+    session_keys = {
+        "check_again_at": "tos_check_again_at",
+        "grace_expires": "tos_grace_period_expires",
+        "digest": "tos_agreed_digest",
+    }
+
+    def __init__(self, request):
+        self.request = request
+
+    def get(self, userid):
+        session = self.request.session
+        found = {}
+        for k, session_key in self.session_keys.items():
+            if session_key in session:
+                found[k] = session[session_key]
+        return found
+
+    def update(self, userid, values):
+        session = self.request.session
+        changed = False
+        for k, value in values.items():
+            session_key = self.session_keys[k]
+            if value is None:
+                if session_key in session:
+                    del session[session_key]
+                    changed = True
+            else:
+                session[session_key] = value
+                changed = True
+        if changed:
+            session.changed()
+
+
+@implementer(IEnforcementState)
+class MemoryState(object):
+    """ In-process LRU, for single process deployments and testing. """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, userid):
+        with self._lock:
+            try:
+                values = self._data.pop(userid)
+            except KeyError:
+                return {}
+            self._data[userid] = values
+            return dict(values)
+
+    def update(self, userid, values):
+        with self._lock:
+            found = self._data.pop(userid, {})
+            for k, value in values.items():
+                if value is None:
+                    found.pop(k, None)
+                else:
+                    found[k] = value
+            if found:
+                self._data[userid] = found
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+@implementer(IEnforcementState)
+class SQLiteState(object):
+    """ Shared between processes on the same host. """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS enforcement_state ("
+                "userid TEXT PRIMARY KEY, "
+                "check_again_at REAL, "
+                "grace_expires REAL, "
+                "digest TEXT)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get(self, userid):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT check_again_at, grace_expires, digest "
+                "FROM enforcement_state WHERE userid = ?",
+                (userid,),
+            ).fetchone()
+        if row is None:
+            return {}
+        found = {}
+        for k, value in zip(KEYS, row):
+            if value is not None:
+                found[k] = k in TIME_KEYS and _from_timestamp(value) or value
+        return found
+
+    def update(self, userid, values):
+        keys = [k for k in KEYS if k in values]
+        if not keys:
+            return
+        params = []
+        for k in keys:
+            value = values[k]
+            if value is not None and k in TIME_KEYS:
+                value = _to_timestamp(value)
+            params.append(value)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO enforcement_state (userid, %s) VALUES (?, %s) "
+                "ON CONFLICT(userid) DO UPDATE SET %s"
+                % (
+                    ", ".join(keys),
+                    ", ".join("?" for k in keys),
+                    ", ".join("%s = excluded.%s" % (k, k) for k in keys),
+                ),
+                [userid] + params,
+            )
+
+
+@implementer(IEnforcementState)
+class RedisState(object):
+    """ One hash per userid. client is anything with the same methods as
+        redis.StrictRedis, for instance FakeRedis.
+        Entries expire after ttl seconds without changes.
+    """
+
+    def __init__(self, client, prefix="arche_tos:state:", ttl=7 * 24 * 60 * 60):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kw):
+        import redis
+
+        return cls(redis.StrictRedis.from_url(url), **kw)
+
+    def get(self, userid):
+        found = {}
+        for k, value in self.client.hgetall(self.prefix + userid).items():
+            if isinstance(k, bytes):
+                k = k.decode("utf-8")
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            if k in TIME_KEYS:
+                value = _from_timestamp(value)
+            found[k] = value
+        return found
+
+    def update(self, userid, values):
+        name = self.prefix + userid
+        removed = [k for k in KEYS if k in values and values[k] is None]
+        mapping = {}
+        for k in KEYS:
+            value = values.get(k, None)
+            if value is not None:
+                mapping[k] = k in TIME_KEYS and repr(_to_timestamp(value)) or value
+        if removed:
+            self.client.hdel(name, *removed)
+        if mapping:
+            self.client.hset(name, mapping=mapping)
+            self.client.expire(name, self.ttl)
+
+
+class FakeRedis(object):
+    """ The few Redis commands RedisState uses, in memory. Meant for testing. """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _check_expired(self, name):
+        if name in self.expires and self.expires[name] < time.time():
+            self.data.pop(name, None)
+            del self.expires[name]
+
+    def hgetall(self, name):
+        self._check_expired(name)
+        return dict(
+            (k.encode("utf-8"), v.encode("utf-8"))
+            for k, v in self.data.get(name, {}).items()
+        )
+
+    def hset(self, name, mapping):
+        self._check_expired(name)
+        self.data.setdefault(name, {}).update(
+            dict((k, str(v)) for k, v in mapping.items())
+        )
+        return len(mapping)
+
+    def hdel(self, name, *keys):
+        self._check_expired(name)
+        found = self.data.get(name, {})
+        removed = 0
+        for k in keys:
+            if found.pop(k, None) is not None:
+                removed += 1
+        if name in self.data and not found:
+            del self.data[name]
+        return removed
+
+    def expire(self, name, seconds):
+        if name in self.data:
+            self.expires[name] = time.time() + seconds
+            return True
+        return False
+
+
+def state_from_setting(value, maxsize=10000):
+    if value == "memory":
+        return MemoryState(maxsize)
+    if value.startswith("sqlite:///"):
+        return SQLiteState(value[len("sqlite:///"):])
+    if value.startswith("redis://") or value.startswith("rediss://"):
+        return RedisState.from_url(value)
+    raise ValueError("Unknown arche_tos.enforcement_state: %s" % value)
+
+
+def includeme(config):
+    """
+    arche_tos.enforcement_state = memory | sqlite:///<path> | redis://<host>:<port>/<db>
+    arche_tos.enforcement_state_size = <int, max users kept by memory, default 10000>
+    """
+    settings = config.registry.settings
+    value = settings.get("arche_tos.enforcement_state", None)
+    if value:
+        maxsize = int(settings.get("arche_tos.enforcement_state_size", 10000))
+        config.registry.registerUtility(
+            state_from_setting(value, maxsize), IEnforcementState
+        )
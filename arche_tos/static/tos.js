@@ -1,4 +1,5 @@
-
 $(function() {
+    // Only included when terms are pending. The form has an ETag,
+    // so browsers revalidate instead of fetching it again.
     arche.create_modal('/tos_form', {backdrop: 'static', 'modal-dialog-class': 'modal-lg'});
 });
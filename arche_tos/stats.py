@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" Timing and counters for TOS enforcement.
+
+    Everything is reported to a sink registered as an IStatsSink utility.
+    A statsd sink is used if arche_tos.statsd_host is set, otherwise nothing
+    is sent anywhere. Each request also keeps its own summary as
+    request.tos_stats, which is handy for debug toolbars.
+"""
+import socket
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger
+
+from zope.interface import implementer
+
+from arche_tos.interfaces import IStatsSink
+
+logger = getLogger(__name__)
+
+
+@implementer(IStatsSink)
+class NullSink(object):
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, ms):
+        pass
+
+
+@implementer(IStatsSink)
+class MemorySink(object):
+    """ Keeps everything in memory, mostly for testing. """
+
+    def __init__(self):
+        self.reset()
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, ms):
+        self.timings.setdefault(name, []).append(ms)
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+
+@implementer(IStatsSink)
+class StatsdSink(object):
+    """ Send stats to a statsd server over UDP. Never raises on network errors. """
+
+    def __init__(self, host="localhost", port=8125, prefix="arche_tos"):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data.encode("utf-8"), self.address)
+        except (socket.error, socket.gaierror):
+            logger.debug("Failed to send stats to %s:%s", *self.address)
+
+    def incr(self, name, value=1):
+        self._send("%s.%s:%s|c" % (self.prefix, name, value))
+
+    def timing(self, name, ms):
+        self._send("%s.%s:%.3f|ms" % (self.prefix, name, ms))
+
+
+class RequestStats(object):
+    """ Collects stats for one request and passes them on to the sink. """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.sink.incr(name, value)
+
+    def timing(self, name, ms):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+        self.sink.timing(name, ms)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, (time.time() - start) * 1000)
+
+    def summary(self):
+        return {"counters": dict(self.counters), "timings_ms": dict(self.timings)}
+
+
+def tos_stats(request):
+    sink = request.registry.queryUtility(IStatsSink)
+    if sink is None:
+        sink = NullSink()
+    return RequestStats(sink)
+
+
+def _timed_iter(stats, name, iterable):
+    start = time.time()
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        stats.timing(name, (time.time() - start) * 1000)
+
+
+def timed(name):
+    """ Time a function or method where the first argument has a request attribute,
+        like a TOSManager, a view or an event.
+        If the function returns an iterator, the time to exhaust it is measured.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(obj, *args, **kw):
+            stats = obj.request.tos_stats
+            start = time.time()
+            try:
+                result = func(obj, *args, **kw)
+            except Exception:
+                stats.timing(name, (time.time() - start) * 1000)
+                raise
+            if isinstance(result, Iterator):
+                return _timed_iter(stats, name, result)
+            stats.timing(name, (time.time() - start) * 1000)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def includeme(config):
+    """
+    arche_tos.statsd_host = <hostname>
+    arche_tos.statsd_port = <int, default 8125>
+    arche_tos.statsd_prefix = <default arche_tos>
+    """
+    settings = config.registry.settings
+    host = settings.get("arche_tos.statsd_host", None)
+    if host:
+        sink = StatsdSink(
+            host,
+            settings.get("arche_tos.statsd_port", 8125),
+            settings.get("arche_tos.statsd_prefix", "arche_tos"),
+        )
+        config.registry.registerUtility(sink, IStatsSink)
+    config.add_request_method(tos_stats, reify=True)
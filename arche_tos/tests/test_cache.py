@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from unittest import TestCase
+
+import transaction
+from persistent import Persistent
+from pyramid import testing
+from ZODB import DB
+
+
+class _Root(Persistent):
+    uid = "root"
+
+
+def _info(uid, lang="", revision=0, effective_from=None, expires_at=None):
+    from arche_tos.cache import TOSInfo
+
+    return TOSInfo(
+        uid=uid,
+        lang=lang,
+        title=uid.title(),
+        is_active=True,
+        docid=1,
+        revision=revision,
+        collapse_text=False,
+        path=(uid,),
+        consent_version=0,
+        effective_from=effective_from,
+        expires_at=expires_at,
+    )
+
+
+class ActiveTOSCacheTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.db = DB(None)
+        self.conn = self.db.open()
+        self.root = self.conn.root()["app"] = _Root()
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        testing.tearDown()
+
+    def _make(self):
+        from arche_tos.cache import ActiveTOSCache
+        from arche_tos.cache import ActiveTOSSnapshot
+
+        class _Cache(ActiveTOSCache):
+            built = 0
+
+            def build(self, request, generation, locale_name):
+                self.built += 1
+                return ActiveTOSSnapshot(generation, [])
+
+        return _Cache()
+
+    def _request(self):
+        from arche_tos.stats import MemorySink
+        from arche_tos.stats import RequestStats
+
+        request = testing.DummyRequest()
+        request.root = self.root
+        request.tos_stats = RequestStats(MemorySink())
+        return request
+
+    def test_built_once_per_generation(self):
+        from arche_tos.cache import bump_tos_generation
+
+        cache = self._make()
+        first = cache.get(self._request(), "sv")
+        self.assertIs(cache.get(self._request(), "sv"), first)
+        self.assertEqual(cache.built, 1)
+        bump_tos_generation(self.root)
+        transaction.commit()
+        second = cache.get(self._request(), "sv")
+        self.assertIsNot(second, first)
+        self.assertEqual(second.generation, 1)
+        self.assertIs(cache.get(self._request(), "sv"), second)
+        self.assertEqual(cache.built, 2)
+
+    def test_per_locale(self):
+        cache = self._make()
+        cache.get(self._request(), "sv")
+        cache.get(self._request(), "en")
+        self.assertEqual(cache.built, 2)
+
+    def test_uncommitted_generation_not_cached(self):
+        from arche_tos.cache import bump_tos_generation
+
+        cache = self._make()
+        cache.get(self._request())
+        bump_tos_generation(self.root)
+        cache.get(self._request())
+        cache.get(self._request())
+        self.assertEqual(cache.built, 3)
+        transaction.abort()
+        cache.get(self._request())
+        self.assertEqual(cache.built, 3)
+
+    def test_modified(self):
+        from arche_tos.cache import bump_tos_generation
+        from arche_tos.cache import get_tos_modified
+
+        self.assertIsNone(get_tos_modified(self.root))
+        bump_tos_generation(self.root)
+        self.assertIsNotNone(get_tos_modified(self.root))
+        self.assertFalse(hasattr(self.root, "_tos_modified"))
+
+
+class LastModifiedTests(TestCase):
+    def test_conflict_keeps_latest(self):
+        from arche_tos.cache import LastModified
+
+        old = {"value": datetime(2020, 1, 1, tzinfo=timezone.utc)}
+        earlier = {"value": datetime(2020, 1, 2, tzinfo=timezone.utc)}
+        later = {"value": datetime(2020, 1, 3, tzinfo=timezone.utc)}
+        obj = LastModified()
+        self.assertEqual(obj._p_resolveConflict(old, later, earlier), later)
+        self.assertEqual(obj._p_resolveConflict(old, earlier, later), later)
+
+
+class ActiveTOSSnapshotTests(TestCase):
+    def _make(self, items):
+        from arche_tos.cache import ActiveTOSSnapshot
+
+        return ActiveTOSSnapshot(1, items)
+
+    def test_for_locale(self):
+        snapshot = self._make(
+            [_info("a"), _info("b", lang="sv"), _info("c", lang="en")]
+        )
+        self.assertEqual(snapshot.uids("sv"), frozenset(["a", "b"]))
+        self.assertEqual(snapshot.uids("de"), frozenset(["a"]))
+
+    def test_digest_changes_with_revision(self):
+        first = self._make([_info("a")]).digest("sv")
+        self.assertEqual(self._make([_info("a")]).digest("sv"), first)
+        self.assertNotEqual(self._make([_info("a", revision=1)]).digest("sv"), first)
+
+    def test_scheduled(self):
+        now = datetime(2020, 1, 10, tzinfo=timezone.utc)
+        day = timedelta(days=1)
+        snapshot = self._make(
+            [
+                _info("a"),
+                _info("b", effective_from=now + day),
+                _info("c", expires_at=now + day),
+            ]
+        )
+        self.assertEqual(snapshot.uids("sv", now), frozenset(["a", "c"]))
+        self.assertEqual(snapshot.uids("sv", now + 2 * day), frozenset(["a", "b"]))
+        # started_at decides when scheduled terms are shown
+        self.assertEqual(snapshot.uids("sv", now + 2 * day, now), frozenset(["a"]))
+
+
+class FragmentCacheTests(TestCase):
+    def test_lru(self):
+        from arche_tos.cache import FragmentCache
+
+        cache = FragmentCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(len(cache), 2)
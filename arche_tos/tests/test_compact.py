@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from unittest import TestCase
+
+from arche.testing import barebone_fixture
+from pyramid import testing
+
+
+class CompactConsentTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _fixture(self):
+        from arche.resources import User
+        from arche_tos.models import AgreedTOS
+        from arche_tos.models import RevokedTOS
+
+        root = barebone_fixture(self.config)
+        root["users"]["jane"] = user = User(email="jane@betahaus.net")
+        # Consent stored before compact storage was enabled
+        AgreedTOS(user).accept_tos("a", date(2020, 1, 1))
+        AgreedTOS(user).accept_tos("b", date(2020, 1, 2))
+        RevokedTOS(user).revoke_tos("c", date(2020, 1, 3))
+        return root, user
+
+    def test_unmigrated_user_revokes(self):
+        from arche_tos.compact import CompactAgreedTOS
+
+        root, user = self._fixture()
+        self.assertFalse(hasattr(root, "_tos_ordinals"))
+        agreed = CompactAgreedTOS(user)
+        del agreed["a"]
+        self.assertEqual(list(agreed), ["b"])
+        self.assertEqual(agreed["b"], date(2020, 1, 2))
+        self.assertFalse(hasattr(user, "_agreed_tos"))
+
+    def test_unmigrated_user_agrees_again(self):
+        from arche_tos.compact import CompactAgreedTOS
+        from arche_tos.compact import CompactRevokedTOS
+
+        root, user = self._fixture()
+        agreed = CompactAgreedTOS(user)
+        revoked = CompactRevokedTOS(user)
+        # What TOSManager.agree_to does when a newer version replaces "a"
+        del agreed["a"]
+        agreed.accept_tos("a@1", date(2020, 2, 1))
+        del revoked["c"]
+        agreed.accept_tos("c", date(2020, 2, 1))
+        self.assertEqual(set(agreed), set(["a@1", "b", "c"]))
+        self.assertEqual(len(revoked), 0)
+
+    def test_unmigrated_user_delete_unknown(self):
+        from arche_tos.compact import CompactAgreedTOS
+
+        root, user = self._fixture()
+        agreed = CompactAgreedTOS(user)
+        self.assertRaises(KeyError, agreed.__delitem__, "404")
+        self.assertEqual(set(agreed), set(["a", "b"]))
+
+    def test_reading_writes_nothing(self):
+        from arche_tos.compact import CompactAgreedTOS
+        from arche_tos.compact import CompactRevokedTOS
+
+        root, user = self._fixture()
+        agreed = CompactAgreedTOS(user)
+        self.assertEqual(agreed["a"], date(2020, 1, 1))
+        self.assertEqual(set(agreed), set(["a", "b"]))
+        self.assertEqual(agreed.missing(["a", "z"]), frozenset(["z"]))
+        self.assertEqual(dict(CompactRevokedTOS(user)), {"c": date(2020, 1, 3)})
+        self.assertFalse(hasattr(root, "_tos_ordinals"))
+        self.assertFalse(hasattr(user, "_agreed_tos_compact"))
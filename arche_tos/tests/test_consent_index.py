@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from unittest import TestCase
+
+
+class ConsentIndexTests(TestCase):
+    @property
+    def _cut(self):
+        from arche_tos.consent_index import ConsentIndex
+
+        return ConsentIndex
+
+    def test_collect_any_consent_version(self):
+        index = self._cut()
+        index.add("agreed", "a", "jane", date(2020, 1, 1))
+        index.add("agreed", "a@2", "john", date(2020, 1, 2))
+        index.add("agreed", "ab", "jim", date(2020, 1, 3))
+        self.assertEqual(sorted(index.keys_for("agreed", "a")), ["a", "a@2"])
+        self.assertEqual(
+            index.collect("agreed", ["a"]),
+            {"jane": {"a": date(2020, 1, 1)}, "john": {"a": date(2020, 1, 2)}},
+        )
+        self.assertEqual(index.collect("agreed")["john"], {"a": date(2020, 1, 2)})
+
+    def test_remove_user(self):
+        index = self._cut()
+        index.add("agreed", "a", "jane", date(2020, 1, 1))
+        index.add("agreed", "a", "john", date(2020, 1, 1))
+        index.add("revoked", "b", "jane", date(2020, 1, 2))
+        index.remove_user("jane")
+        self.assertEqual(index.count("agreed", "a"), 1)
+        self.assertEqual(index.count("revoked", "b"), 0)
+        self.assertEqual(index.histogram("agreed", "a"), [(date(2020, 1, 1), 1)])
+        self.assertEqual(index.histogram("revoked", "b"), [])
+        self.assertEqual(dict(index.get_users("agreed", "a")), {"john": date(2020, 1, 1)})
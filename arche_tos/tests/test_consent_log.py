@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from datetime import datetime
+from datetime import timezone
+from unittest import TestCase
+
+
+def _ts(day, hour=12):
+    return datetime(2020, 1, day, hour, tzinfo=timezone.utc).timestamp()
+
+
+class ConsentLogTests(TestCase):
+    def _make(self):
+        from arche_tos.consent_log import ConsentLog
+
+        log = ConsentLog()
+        log.append("jane", "a", "agree", 1, timestamp=_ts(1))
+        log.append("john", "a", "agree", 1, timestamp=_ts(1, 13))
+        log.append("jane", "a", "revoke", 2, timestamp=_ts(2))
+        log.append("jane", "b", "agree", 1, timestamp=_ts(3))
+        return log
+
+    def _keys(self, events):
+        return [(x.userid, x.tos_uid, x.action) for x in events]
+
+    def test_bad_action(self):
+        from arche_tos.consent_log import ConsentLog
+
+        self.assertRaises(ValueError, ConsentLog().append, "jane", "a", "ignore")
+
+    def test_same_timestamp_kept(self):
+        from arche_tos.consent_log import ConsentLog
+
+        log = ConsentLog()
+        log.append("jane", "a", "agree", timestamp=_ts(1))
+        log.append("jane", "a", "revoke", timestamp=_ts(1))
+        self.assertEqual(len(log), 2)
+
+    def test_compact(self):
+        log = self._make()
+        self.assertEqual(log.compact(before=date(2020, 1, 3)), 3)
+        self.assertEqual(len(log.recent), 1)
+        self.assertEqual(
+            sorted(log.segments.keys()),
+            [date(2020, 1, 1).toordinal(), date(2020, 1, 2).toordinal()],
+        )
+        self.assertEqual(len(log), 4)
+
+    def test_query_same_before_and_after_compact(self):
+        log = self._make()
+        queries = (
+            {},
+            {"userid": "jane"},
+            {"tos_uid": "a"},
+            {"userid": "jane", "tos_uid": "a"},
+            {"start": datetime(2020, 1, 1, 13, tzinfo=timezone.utc)},
+            {"end": datetime(2020, 1, 2, tzinfo=timezone.utc)},
+        )
+        before = [self._keys(log.query(**kw)) for kw in queries]
+        log.compact(before=date(2020, 1, 3))
+        after = [self._keys(log.query(**kw)) for kw in queries]
+        self.assertEqual(before, after)
+        self.assertEqual(
+            after[1],
+            [("jane", "a", "agree"), ("jane", "a", "revoke"), ("jane", "b", "agree")],
+        )
+        self.assertEqual(after[4][0], ("john", "a", "agree"))
+        self.assertEqual(len(after[5]), 2)
+
+    def test_late_events_merged(self):
+        log = self._make()
+        log.compact(before=date(2020, 1, 3))
+        log.append("jim", "a", "agree", 1, timestamp=_ts(1, 8))
+        log.compact(before=date(2020, 1, 3))
+        day = log.segments[date(2020, 1, 1).toordinal()]
+        self.assertEqual(
+            self._keys(day.events),
+            [("jim", "a", "agree"), ("jane", "a", "agree"), ("john", "a", "agree")],
+        )
+        self.assertEqual(self._keys(log.query(userid="jim")), [("jim", "a", "agree")])
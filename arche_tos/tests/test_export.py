@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import os
+from datetime import date
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from unittest import mock
+
+import transaction
+from arche.testing import barebone_fixture
+from pyramid import testing
+from ZODB import DB
+
+
+class IterRevokedUsersTests(TestCase):
+    expected = {
+        "jane": {"a": date(2020, 1, 1), "b": date(2020, 1, 1)},
+        "john": {"b": date(2020, 1, 1)},
+    }
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_tos.export import iter_revoked_users
+
+        return iter_revoked_users
+
+    def _fixture(self):
+        from arche.resources import User
+        from arche_tos.models import RevokedTOS
+
+        root = barebone_fixture(self.config)
+        users = (("jane", ("a", "b")), ("john", ("b",)), ("jim", ("c",)))
+        for userid, revoked in users:
+            root["users"][userid] = user = User(email="%s@betahaus.net" % userid)
+            for uid in revoked:
+                RevokedTOS(user).revoke_tos(uid, date(2020, 1, 1))
+        return root
+
+    def _result(self, root):
+        found = {}
+        for user, revoked in self._fut(root, ["a", "b"]):
+            found.setdefault(user.userid, {}).update(revoked)
+        return found
+
+    def test_scan_without_index(self):
+        root = self._fixture()
+        root._tos_consent_index.built = False
+        self.assertEqual(self._result(root), self.expected)
+
+    def test_built_index(self):
+        root = self._fixture()
+        root._tos_consent_index.built = True
+        self.assertEqual(self._result(root), self.expected)
+
+    def test_lazy(self):
+        root = self._fixture()
+        root._tos_consent_index.built = True
+        users = self._fut(root, ["a", "b"])
+        user, revoked = next(users)
+        self.assertEqual((user.userid, revoked), ("jane", {"a": date(2020, 1, 1)}))
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class ExportConsentTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.tmpdir = mkdtemp()
+        self.db = DB(None)
+        self.conn = self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        rmtree(self.tmpdir)
+        testing.tearDown()
+
+    def _fixture(self):
+        from arche.resources import User
+        from arche_tos.models import AgreedTOS
+        from arche_tos.models import RevokedTOS
+
+        root = barebone_fixture(self.config)
+        self.conn.root()["app"] = root
+        for i in range(5):
+            userid = "user%s" % i
+            root["users"][userid] = user = User(email="%s@betahaus.net" % userid)
+            AgreedTOS(user).accept_tos("a@1", date(2020, 1, i + 1))
+            if i % 2:
+                RevokedTOS(user).revoke_tos("b", date(2020, 2, i + 1))
+        transaction.commit()
+        return root
+
+    def _export(self, root, output, **kw):
+        from arche_tos.export import export_consent
+
+        # No TOS exist, so skip the catalog
+        with mock.patch("arche_tos.export.tos_catalog_info", return_value={}):
+            return export_consent(root, output, chunk_size=2, **kw)
+
+    def _read(self, path):
+        with gzip.open(path, "rb") as f:
+            return [json.loads(x) for x in f.read().decode("utf-8").splitlines()]
+
+    def test_rows(self):
+        root = self._fixture()
+        output = os.path.join(self.tmpdir, "all.jsonl.gz")
+        state = self._export(root, output)
+        self.assertEqual(state["users"], 5)
+        self.assertEqual(state["rows"], 7)
+        self.assertTrue(state["done"])
+        rows = self._read(output)
+        self.assertEqual(rows[0]["userid"], "user0")
+        self.assertEqual(rows[0]["tos_uid"], "a")
+        self.assertEqual(rows[0]["consent_version"], 1)
+        self.assertEqual(rows[2]["state"], "revoked")
+
+    def test_resume(self):
+        root = self._fixture()
+        expected = os.path.join(self.tmpdir, "expected.jsonl.gz")
+        self._export(root, expected)
+        output = os.path.join(self.tmpdir, "out.jsonl.gz")
+        checkpoint = os.path.join(self.tmpdir, "checkpoint")
+
+        def _interrupt(state):
+            if state["users"] >= 2:
+                raise _Interrupted()
+
+        self.assertRaises(
+            _Interrupted,
+            self._export,
+            root,
+            output,
+            checkpoint=checkpoint,
+            progress=_interrupt,
+        )
+        # Half a chunk written after the checkpoint is discarded
+        with open(output, "ab") as f:
+            f.write(b"garbage")
+        state = self._export(root, output, checkpoint=checkpoint)
+        self.assertEqual(state["users"], 5)
+        self.assertEqual(self._read(output), self._read(expected))
+        # Nothing more to do once it's done
+        self.assertEqual(self._export(root, output, checkpoint=checkpoint), state)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from arche.utils import utcnow
+from pyramid import testing
+
+
+class GracePeriodTests(TestCase):
+    """ Kicked out after the grace period, log in again and get the modal,
+        for every place enforcement state can be kept.
+    """
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.testing_securitypolicy(userid="jane")
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        testing.tearDown()
+        rmtree(self.tmpdir)
+
+    @property
+    def _cut(self):
+        from arche_tos.models import TOSManager
+
+        return TOSManager
+
+    def _register_state(self, state):
+        from arche_tos.interfaces import IEnforcementState
+
+        self.config.registry.registerUtility(state, IEnforcementState)
+
+    def _login(self):
+        """ A new request with a new session, like after logging in again. """
+        return self._cut(testing.DummyRequest())
+
+    def _check_kick_login_modal(self):
+        from arche_tos.exceptions import TermsNotAccepted
+
+        manager = self._login()
+        manager._update_state(grace_expires=utcnow() - timedelta(seconds=1))
+        self.assertRaises(TermsNotAccepted, manager.check_grace_period)
+        # After login, a new grace period starts, so the modal is shown instead
+        manager = self._login()
+        manager.check_grace_period()
+        self.assertGreater(manager.check_state["grace_expires"], utcnow())
+
+    def _check_clear_state(self):
+        """ What terms_not_accepted does. """
+        manager = self._login()
+        manager._update_state(
+            grace_expires=utcnow() - timedelta(seconds=1), digest="abc"
+        )
+        manager.clear_state()
+        self.assertEqual(self._login().check_state, {})
+
+    def test_session(self):
+        self._check_kick_login_modal()
+
+    def test_memory(self):
+        from arche_tos.state import MemoryState
+
+        self._register_state(MemoryState())
+        self._check_kick_login_modal()
+        self._check_clear_state()
+
+    def test_sqlite(self):
+        from arche_tos.state import SQLiteState
+
+        self._register_state(SQLiteState(os.path.join(self.tmpdir, "state.db")))
+        self._check_kick_login_modal()
+        self._check_clear_state()
+
+    def test_redis(self):
+        from arche_tos.state import FakeRedis
+        from arche_tos.state import RedisState
+
+        self._register_state(RedisState(FakeRedis()))
+        self._check_kick_login_modal()
+        self._check_clear_state()
+
+
+class AgreeTokenTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _info(self, uid, revision=0):
+        from arche_tos.cache import TOSInfo
+
+        return TOSInfo(
+            uid=uid,
+            lang="",
+            title=uid.title(),
+            is_active=True,
+            docid=1,
+            revision=revision,
+            collapse_text=False,
+            path=(uid,),
+            consent_version=0,
+            effective_from=None,
+            expires_at=None,
+        )
+
+    def _make(self, active, pending):
+        from arche_tos.models import TOSManager
+
+        manager = TOSManager(testing.DummyRequest())
+        manager.active_tos_info = lambda: active
+        manager.pending_uids = frozenset(pending)
+        return manager
+
+    def test_roundtrip(self):
+        active = [self._info("a", 1), self._info("b", 2)]
+        manager = self._make(active, ["a", "b"])
+        token = manager.make_agree_token(active)
+        self.assertEqual(manager.verify_agree_token(token), active)
+
+    def test_only_pending_shown(self):
+        active = [self._info("a", 1), self._info("b", 2)]
+        manager = self._make(active, ["b"])
+        token = manager.make_agree_token(active[1:])
+        self.assertEqual(manager.verify_agree_token(token), active[1:])
+
+    def test_changed_revision(self):
+        manager = self._make([self._info("a", 2)], ["a"])
+        token = manager.make_agree_token([self._info("a", 1)])
+        self.assertRaises(ValueError, manager.verify_agree_token, token)
+
+    def test_pending_not_shown(self):
+        active = [self._info("a"), self._info("b")]
+        manager = self._make(active, ["a", "b"])
+        token = manager.make_agree_token(active[:1])
+        self.assertRaises(ValueError, manager.verify_agree_token, token)
+
+    def test_no_longer_active(self):
+        manager = self._make([self._info("a")], ["a"])
+        token = manager.make_agree_token([self._info("a"), self._info("gone")])
+        self.assertRaises(ValueError, manager.verify_agree_token, token)
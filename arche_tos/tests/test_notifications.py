@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+import transaction
+from zope.interface.verify import verifyObject
+
+
+class NotificationQueueTests(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _make(self, **kw):
+        from arche_tos.notifications import NotificationQueue
+
+        return NotificationQueue(os.path.join(self.tmpdir, "queue.db"), **kw)
+
+    def test_iface(self):
+        from arche_tos.interfaces import INotificationQueue
+
+        self.assertTrue(verifyObject(INotificationQueue, self._make()))
+
+    def test_claim_ack(self):
+        queue = self._make()
+        queue.put("jane", "Jane", ["a", "b"])
+        queue.put("john", "John", ["a"])
+        token, records = queue.claim()
+        self.assertEqual([x["userid"] for x in records], ["jane", "john"])
+        self.assertEqual(records[0]["tos_uids"], ["a", "b"])
+        # Claimed records aren't handed out twice
+        self.assertEqual(queue.claim()[1], [])
+        queue.ack(token)
+        self.assertEqual(len(queue), 0)
+
+    def test_release(self):
+        queue = self._make()
+        queue.put("jane", "Jane", ["a"])
+        token, records = queue.claim()
+        queue.release(token)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual([x["userid"] for x in queue.claim()[1]], ["jane"])
+
+    def test_claim_limit(self):
+        queue = self._make()
+        for userid in ("jane", "john", "jim"):
+            queue.put(userid, userid.title(), ["a"])
+        token, records = queue.claim(limit=2)
+        self.assertEqual([x["userid"] for x in records], ["jane", "john"])
+        queue.ack(token)
+        self.assertEqual([x["userid"] for x in queue.claim()[1]], ["jim"])
+
+    def test_stale_claims_claimed_again(self):
+        queue = self._make(stale_seconds=-1)
+        queue.put("jane", "Jane", ["a"])
+        first, records = queue.claim()
+        second, records = queue.claim()
+        self.assertNotEqual(first, second)
+        self.assertEqual([x["userid"] for x in records], ["jane"])
+        # The abandoned claim no longer removes anything
+        queue.ack(first)
+        self.assertEqual(len(queue), 1)
+
+    def test_enqueue_after_commit(self):
+        from arche_tos.notifications import _enqueue_after_commit
+
+        queue = self._make()
+        transaction.begin()
+        _enqueue_after_commit(queue, [("jane", "Jane", ["a"])])
+        self.assertEqual(len(queue), 0)
+        transaction.commit()
+        self.assertEqual(len(queue), 1)
+
+    def test_enqueue_aborted(self):
+        from arche_tos.notifications import _enqueue_after_commit
+
+        queue = self._make()
+        transaction.begin()
+        _enqueue_after_commit(queue, [("jane", "Jane", ["a"])])
+        transaction.abort()
+        self.assertEqual(len(queue), 0)
+
+
+class RenderForRecipientsTests(TestCase):
+    def tearDown(self):
+        from arche_tos.cache import email_body_cache
+
+        email_body_cache.clear()
+
+    @property
+    def _fut(self):
+        from arche_tos.notifications import render_for_recipients
+
+        return render_for_recipients
+
+    def test_title_per_recipient(self):
+        from arche_tos.cache import ConsentManagerInfo
+        from arche_tos.cache import email_body_cache
+        from arche_tos.notifications import RECIPIENT_TITLE
+
+        # Already rendered, so the template is never used
+        email_body_cache.set("key", "<p>Hello %s</p>" % RECIPIENT_TITLE)
+        recipients = (
+            ConsentManagerInfo("jane", "jane@betahaus.net", "Jane"),
+            ConsentManagerInfo("evil", "evil@betahaus.net", "<b>Evil</b>"),
+        )
+        found = list(self._fut(None, "missing.pt", {}, recipients, cache_key="key"))
+        self.assertEqual(
+            [html for recipient, html in found],
+            ["<p>Hello Jane</p>", "<p>Hello &lt;b&gt;Evil&lt;/b&gt;</p>"],
+        )
+
+    def test_no_recipients(self):
+        self.assertEqual(list(self._fut(None, "missing.pt", {}, ())), [])
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from unittest import TestCase
+
+from arche.testing import barebone_fixture
+from pyramid import testing
+
+
+class SplitRangesTests(TestCase):
+    @property
+    def _fut(self):
+        from arche_tos.scan import split_ranges
+
+        return split_ranges
+
+    def test_split(self):
+        userids = ["u%02d" % i for i in range(10)]
+        self.assertEqual(
+            self._fut(userids, 3), [("u00", "u03"), ("u04", "u07"), ("u08", "u09")]
+        )
+
+    def test_more_parts_than_users(self):
+        self.assertEqual(self._fut(["a", "b"], 8), [("a", "a"), ("b", "b")])
+
+    def test_empty(self):
+        self.assertEqual(self._fut([], 4), [])
+
+
+class ScanResultTests(TestCase):
+    def test_merge(self):
+        from arche_tos.scan import ScanResult
+
+        first = ScanResult()
+        first.users = 2
+        first.agreed = {"a": 2}
+        first.pending_users = {"jane": ["b"]}
+        second = ScanResult()
+        second.users = 1
+        second.agreed = {"a": 1, "b": 1}
+        second.pending_users = {"john": ["b"]}
+        result = first.merge(second)
+        self.assertEqual(result.users, 3)
+        self.assertEqual(result.agreed, {"a": 3, "b": 1})
+        self.assertEqual(result.pending_users, {"jane": ["b"], "john": ["b"]})
+
+
+class ScanUsersTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_scan(self):
+        from arche.resources import User
+        from arche_tos.models import AgreedTOS
+        from arche_tos.models import RevokedTOS
+        from arche_tos.scan import scan_users
+
+        root = barebone_fixture(self.config)
+        root["users"]["jane"] = jane = User(email="jane@betahaus.net")
+        root["users"]["john"] = john = User(email="john@betahaus.net")
+        AgreedTOS(jane).accept_tos("a", date(2020, 1, 1))
+        AgreedTOS(jane).accept_tos("b@1", date(2020, 1, 1))
+        AgreedTOS(john).accept_tos("a", date(2020, 1, 1))
+        RevokedTOS(john).revoke_tos("b", date(2020, 1, 2))
+        result = scan_users(
+            [jane, john],
+            frozenset(["a", "b@1"]),
+            collect_revoked=True,
+            collect_pending=True,
+        )
+        self.assertEqual(result.users, 2)
+        self.assertEqual(result.agreed, {"a": 2, "b@1": 1})
+        self.assertEqual(result.revoked, {"b": 1})
+        self.assertEqual(result.pending, {"b@1": 1})
+        self.assertEqual(result.pending_users, {"john": ["b@1"]})
+        self.assertEqual(result.revoked_users, {"john": {"b": date(2020, 1, 2)}})
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import datetime
+from datetime import timezone
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from zope.interface.verify import verifyObject
+
+
+class _StateTests(object):
+    """ Shared by all IEnforcementState implementations. """
+
+    def _make(self):
+        raise NotImplementedError()
+
+    def test_iface(self):
+        from arche_tos.interfaces import IEnforcementState
+
+        self.assertTrue(verifyObject(IEnforcementState, self._make()))
+
+    def test_roundtrip(self):
+        state = self._make()
+        self.assertEqual(state.get("jane"), {})
+        when = datetime(2020, 1, 1, 12, 30, tzinfo=timezone.utc)
+        state.update("jane", {"check_again_at": when, "digest": "abc"})
+        self.assertEqual(state.get("jane"), {"check_again_at": when, "digest": "abc"})
+        self.assertEqual(state.get("john"), {})
+
+    def test_update_keeps_other_keys(self):
+        state = self._make()
+        when = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        state.update("jane", {"grace_expires": when})
+        state.update("jane", {"digest": "abc"})
+        self.assertEqual(state.get("jane"), {"grace_expires": when, "digest": "abc"})
+
+    def test_none_removes(self):
+        state = self._make()
+        when = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        state.update("jane", {"grace_expires": when, "digest": "abc"})
+        state.update("jane", {"grace_expires": None})
+        self.assertEqual(state.get("jane"), {"digest": "abc"})
+        state.update("jane", {"digest": None})
+        self.assertEqual(state.get("jane"), {})
+
+
+class MemoryStateTests(_StateTests, TestCase):
+    def _make(self, maxsize=10):
+        from arche_tos.state import MemoryState
+
+        return MemoryState(maxsize)
+
+    def test_least_recently_used_dropped(self):
+        state = self._make(maxsize=2)
+        state.update("jane", {"digest": "a"})
+        state.update("john", {"digest": "b"})
+        state.get("jane")
+        state.update("jim", {"digest": "c"})
+        self.assertEqual(state.get("john"), {})
+        self.assertEqual(state.get("jane"), {"digest": "a"})
+        self.assertEqual(state.get("jim"), {"digest": "c"})
+
+
+class SQLiteStateTests(_StateTests, TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _make(self):
+        from arche_tos.state import SQLiteState
+
+        return SQLiteState(os.path.join(self.tmpdir, "state.db"))
+
+    def test_shared_between_instances(self):
+        self._make().update("jane", {"digest": "abc"})
+        self.assertEqual(self._make().get("jane"), {"digest": "abc"})
+
+
+class RedisStateTests(_StateTests, TestCase):
+    def _make(self, **kw):
+        from arche_tos.state import FakeRedis
+        from arche_tos.state import RedisState
+
+        return RedisState(FakeRedis(), **kw)
+
+    def test_expires(self):
+        state = self._make(ttl=-1)
+        state.update("jane", {"digest": "abc"})
+        self.assertEqual(state.get("jane"), {})
+
+
+class StateFromSettingTests(TestCase):
+    @property
+    def _fut(self):
+        from arche_tos.state import state_from_setting
+
+        return state_from_setting
+
+    def test_memory(self):
+        from arche_tos.state import MemoryState
+
+        state = self._fut("memory", maxsize=5)
+        self.assertIsInstance(state, MemoryState)
+        self.assertEqual(state.maxsize, 5)
+
+    def test_sqlite(self):
+        from arche_tos.state import SQLiteState
+
+        tmpdir = mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "state.db")
+            state = self._fut("sqlite:///" + path)
+            self.assertIsInstance(state, SQLiteState)
+            self.assertEqual(state.path, path)
+        finally:
+            rmtree(tmpdir)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._fut, "memcached://localhost")
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from pyramid import testing
+
+
+class RequestStatsTests(TestCase):
+    def _make(self):
+        from arche_tos.stats import MemorySink
+        from arche_tos.stats import RequestStats
+
+        return RequestStats(MemorySink())
+
+    def test_passed_on_to_sink(self):
+        stats = self._make()
+        stats.incr("check_performed")
+        stats.incr("docids_resolved", 3)
+        stats.timing("check_terms", 2.5)
+        self.assertEqual(
+            stats.sink.counters, {"check_performed": 1, "docids_resolved": 3}
+        )
+        self.assertEqual(stats.sink.timings, {"check_terms": [2.5]})
+
+    def test_summary(self):
+        stats = self._make()
+        stats.incr("a")
+        stats.incr("a")
+        stats.timing("t", 1.0)
+        stats.timing("t", 2.0)
+        self.assertEqual(
+            stats.summary(), {"counters": {"a": 2}, "timings_ms": {"t": 3.0}}
+        )
+
+    def test_timer(self):
+        stats = self._make()
+        with stats.timer("catalog_query"):
+            pass
+        self.assertEqual(len(stats.sink.timings["catalog_query"]), 1)
+
+
+class _Timed(object):
+    def __init__(self, request):
+        self.request = request
+
+
+class TimedTests(TestCase):
+    def _make(self, func):
+        from arche_tos.stats import MemorySink
+        from arche_tos.stats import RequestStats
+        from arche_tos.stats import timed
+
+        request = testing.DummyRequest()
+        request.tos_stats = RequestStats(MemorySink())
+        return timed("name")(func), _Timed(request)
+
+    def test_value(self):
+        func, obj = self._make(lambda obj, x: x * 2)
+        self.assertEqual(func(obj, 2), 4)
+        self.assertIn("name", obj.request.tos_stats.timings)
+
+    def test_exception(self):
+        def _raise(obj):
+            raise ValueError()
+
+        func, obj = self._make(_raise)
+        self.assertRaises(ValueError, func, obj)
+        self.assertIn("name", obj.request.tos_stats.timings)
+
+    def test_iterator_timed_when_exhausted(self):
+        func, obj = self._make(lambda obj: iter([1, 2]))
+        result = func(obj)
+        self.assertNotIn("name", obj.request.tos_stats.timings)
+        self.assertEqual(list(result), [1, 2])
+        self.assertIn("name", obj.request.tos_stats.timings)
+
+
+class TosStatsTests(TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_registered_sink(self):
+        from arche_tos.interfaces import IStatsSink
+        from arche_tos.stats import MemorySink
+        from arche_tos.stats import tos_stats
+
+        sink = MemorySink()
+        self.config.registry.registerUtility(sink, IStatsSink)
+        tos_stats(testing.DummyRequest()).incr("a")
+        self.assertEqual(sink.counters, {"a": 1})
+
+    def test_null_sink(self):
+        from arche_tos.stats import NullSink
+        from arche_tos.stats import tos_stats
+
+        self.assertIsInstance(tos_stats(testing.DummyRequest()).sink, NullSink)
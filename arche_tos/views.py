@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
+from hashlib import sha1
+
 import colander
 import deform
 from arche.interfaces import IFlashMessages
 from arche.interfaces import IRoot
 from arche.interfaces import IUser
 from arche.security import PERM_EDIT
+from arche.security import PERM_MANAGE_SYSTEM
 from arche.security import PERM_MANAGE_USERS
 from arche.security import PERM_VIEW
+from arche.utils import utcnow
 from arche.views.actions import generic_submenu_items
 from arche.views.base import BaseForm
 from arche.views.base import BaseView
@@ -14,16 +19,29 @@ from arche.views.base import button_cancel
 from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.renderers import render
 from pyramid.response import Response
 from pyramid.security import forget
-from repoze.catalog.query import Eq
 
 from arche_tos import _
+from arche_tos.cache import tos_fragment_cache
+from arche_tos.cache import tos_listing_cache
+from arche_tos.consent_index import get_consent_index
 from arche_tos.exceptions import TermsNotAccepted
+from arche_tos.export import CONSENT_FIELDNAMES
+from arche_tos.export import EXPORT_FORMATS
+from arche_tos.export import SeparateConnection
+from arche_tos.export import encode_rows
+from arche_tos.export import iter_revoked_rows
+from arche_tos.export import iter_revoked_users
+from arche_tos.export import user_consent_rows
+from arche_tos.interfaces import IAgreedTOS
+from arche_tos.interfaces import IRevokedTOS
 from arche_tos.interfaces import ITOS
 from arche_tos.interfaces import ITOSManager
 from arche_tos.interfaces import ITOSSettings
+from arche_tos.resource import split_consent_key
 
 
 class TOSMixin(object):
@@ -49,9 +67,25 @@ class TOSMixin(object):
             return True
 
     def all_tos(self):
-        """ Regardless of active etc. """
-        docids = self.request.root.catalog.query(Eq("type_name", "TOS"), sort_index="sortable_title")[1]
-        return self.request.resolve_docids(docids, perm=None)
+        """ Cached information about all TOS regardless of active etc, sorted by title.
+            Doesn't load any objects unless TOS changed.
+        """
+        return tos_listing_cache.get(self.request).items
+
+    def tos_url(self, info):
+        return self.request.resource_url(self.request.root, *info.path)
+
+    def tos_body(self, info):
+        """ The body of a TOS from cached information. Only loads the TOS if
+            that revision of it hasn't been shown before.
+        """
+        key = ("body", info.uid, info.revision)
+        html = tos_fragment_cache.get(key)
+        if html is None:
+            for tos in self.tos_manager.resolve_tos_info([info]):
+                html = tos.body
+                tos_fragment_cache.set(key, html)
+        return html or ""
 
     @reify
     def tos_folder(self):
@@ -69,15 +103,81 @@ class TOSForm(BaseForm, TOSMixin):
     def use_ajax(self):
         return self.request.is_xhr
 
+    @reify
+    def shown_tos(self):
+        return self.tos_manager.pending_tos_info()
+
+    @reify
+    def agree_token(self):
+        return self.tos_manager.make_agree_token(self.shown_tos)
+
+    @reify
+    def etag(self):
+        snapshot = self.tos_manager.active_tos_snapshot
+        # The form contains the CSRF token, so it's part of the ETag
+        value = "%s|%s|%s|%s" % (
+            snapshot.generation,
+            self.request.localizer.locale_name,
+            self.agree_token,
+            self.request.session.get_csrf_token(),
+        )
+        return sha1(value.encode("utf-8")).hexdigest()
+
+    def __call__(self):
+        if self.request.method == "GET":
+            # Let browsers revalidate instead of rendering the same form again
+            if self.etag in self.request.if_none_match:
+                response = HTTPNotModified()
+                response.etag = self.etag
+                return response
+            self.request.response.etag = self.etag
+            self.request.response.last_modified = (
+                self.tos_manager.active_tos_snapshot.modified
+            )
+            self.request.response.cache_control = "private, no-cache"
+        return super(TOSForm, self).__call__()
+
+    def render_tos_fragment(self, info):
+        locale_name = self.request.localizer.locale_name
+        key = (info.uid, info.revision, locale_name, info.collapse_text)
+        html = tos_fragment_cache.get(key)
+        if html is None:
+            self.request.tos_stats.incr("fragment_cache.miss")
+            for tos in self.tos_manager.resolve_tos_info([info]):
+                html = render(
+                    "arche_tos:templates/tos_listing_item.pt",
+                    {"tos": tos, "view": self},
+                    request=self.request,
+                )
+                tos_fragment_cache.set(key, html)
+        else:
+            self.request.tos_stats.incr("fragment_cache.hit")
+        return html or ""
+
     def before_fields(self):
-        values = {"tos_items": self.tos_manager.find_tos(), "view": self}
+        values = {
+            "fragments": [self.render_tos_fragment(x) for x in self.shown_tos],
+            "view": self,
+        }
         return render(
             "arche_tos:templates/tos_listing.pt", values, request=self.request
         )
 
     def agree_success(self, appstruct):
+        try:
+            shown = self.tos_manager.verify_agree_token(appstruct["tos_token"])
+        except ValueError:
+            self.flash_messages.add(
+                _(
+                    "tos_changed_while_reading",
+                    default="The terms changed while you were reading them. "
+                    "Please read them again.",
+                ),
+                type="warning",
+            )
+            return self.relocate_response(self.request.resource_url(self.context))
         self.flash_messages.add(_("Thank you!"), type="success")
-        self.tos_manager.agree_to(self.tos_manager.find_tos())
+        self.tos_manager.agree_to(shown)
         if self.use_ajax:
             return Response(
                 render(
@@ -87,17 +187,38 @@ class TOSForm(BaseForm, TOSMixin):
         return HTTPFound(location=self.request.resource_url(self.context))
 
 
+class PendingTOSJSON(BaseView, TOSMixin):
+    """ Lightweight check for the modal script. Returns the TOS the current user
+        needs to agree to, and a hash of the currently active TOS.
+    """
+
+    def __call__(self):
+        pending = []
+        if (
+            self.request.authenticated_userid
+            and self.tos_manager.agreed_tos is not None
+            and not self.request.has_permission(PERM_MANAGE_SYSTEM, self.request.root)
+        ):
+            pending = self.tos_manager.pending_tos_info()
+        return {
+            "pending": [{"uid": x.uid, "title": x.title} for x in pending],
+            "hash": self.tos_manager.active_tos_digest(),
+        }
+
+
 class AgreedTOSView(BaseView, TOSMixin):
     def __call__(self):
         active = []
         inactive = []
-        for uid, date in self.tos_manager.agreed_tos.items():
-            tos = self.request.resolve_uid(uid, perm=None)
-            if tos:
-                if tos.wf_state == "enabled":
-                    active.append((tos, date))
-                else:
-                    inactive.append((tos, date))
+        agreed = {}
+        for key, date in self.tos_manager.agreed_tos.items():
+            agreed[split_consent_key(key)[0]] = date
+        enabled = self.tos_manager.enabled_uids
+        for uid, tos in self.tos_manager.resolve_tos_uids(agreed).items():
+            if uid in enabled:
+                active.append((tos, agreed[uid]))
+            else:
+                inactive.append((tos, agreed[uid]))
         active = sorted(active, key=lambda x: x[1])
         inactive = sorted(inactive, key=lambda x: x[1])
         return {"active_tos": active, "inactive_tos": inactive}
@@ -121,7 +242,7 @@ class RevokeAgreementForm(BaseForm, TOSMixin):
         if uid:
             # Current user probably hasn't got view permission on that object as default.
             # Which is correct, it shouldn't be part of the site.
-            tos = self.request.resolve_uid(uid, perm=None)
+            tos = self.tos_manager.resolve_tos_uids([uid]).get(uid, None)
             if not ITOS.providedBy(tos):
                 raise HTTPNotFound(_("Agreement not found"))
             return tos
@@ -170,7 +291,53 @@ class ManageTOSView(BaseView, TOSMixin):
         return {}
 
 
+class ConsentDashboard(BaseView, TOSMixin):
+    """ Agreed, revoked and pending counts per TOS from the consent index.
+        Renders in constant time regardless of the number of users.
+    """
+
+    histogram_days = 30
+
+    def __call__(self):
+        return {}
+
+    @reify
+    def consent_index(self):
+        return get_consent_index(self.request.root, create=False)
+
+    @reify
+    def user_count(self):
+        return len(self.request.root["users"])
+
+    def stats(self, tos):
+        index = self.consent_index
+        agreed = index.count("agreed", tos.consent_key)
+        revoked = index.count("revoked", tos.uid)
+        # Users language isn't indexed, so pending is unknown for TOS with lang set
+        pending = None
+        if not tos.lang:
+            pending = tos.is_active and max(self.user_count - agreed, 0) or 0
+        percent = self.user_count and 100.0 * agreed / self.user_count or 0.0
+        return {
+            "agreed": agreed,
+            "revoked": revoked,
+            "pending": pending,
+            "percent": percent,
+        }
+
+    def histogram(self, tos):
+        end = utcnow().date()
+        start = end - timedelta(days=self.histogram_days - 1)
+        found = dict(self.consent_index.histogram("agreed", tos.consent_key, start, end))
+        days = [start + timedelta(days=i) for i in range(self.histogram_days)]
+        highest = max(list(found.values()) + [1])
+        return [(day, found.get(day, 0), 100 * found.get(day, 0) // highest) for day in days]
+
+
 class ListRevokedUsers(BaseView, TOSMixin):
+    default_limit = 100
+    max_limit = 1000
+
     def __call__(self):
         return {}
 
@@ -179,9 +346,117 @@ class ListRevokedUsers(BaseView, TOSMixin):
         """ UID as key and a num starting with 1 as value. """
         return dict([(y, x) for x, y in enumerate([x.uid for x in self.active_tos], 1)])
 
-    def get_revoked_users(self):
+    def _int_param(self, name, default, maximum=None):
+        try:
+            value = int(self.request.params.get(name, default))
+        except ValueError:
+            return default
+        value = max(value, 0)
+        if maximum is not None:
+            value = min(value, maximum)
+        return value
+
+    @reify
+    def offset(self):
+        return self._int_param("offset", 0)
+
+    @reify
+    def limit(self):
+        return self._int_param("limit", self.default_limit, self.max_limit) or 1
+
+    def get_revoked_users(self, offset=0, limit=None):
         uids = [x.uid for x in self.active_tos]
-        return self.tos_manager.get_all_revoked_users(filter_tos_uids=uids)
+        return self.tos_manager.get_all_revoked_users(
+            filter_tos_uids=uids, offset=offset, limit=limit
+        )
+
+    @reify
+    def _page(self):
+        # One extra item to know if there's a next page
+        return list(self.get_revoked_users(self.offset, self.limit + 1))
+
+    @reify
+    def revoked_users(self):
+        return self._page[: self.limit]
+
+    @reify
+    def next_url(self):
+        if len(self._page) > self.limit:
+            return self.request.resource_url(
+                self.context,
+                "_list_revoked_tos_users",
+                query={"offset": self.offset + self.limit, "limit": self.limit},
+            )
+
+    @reify
+    def previous_url(self):
+        if self.offset:
+            return self.request.resource_url(
+                self.context,
+                "_list_revoked_tos_users",
+                query={"offset": max(self.offset - self.limit, 0), "limit": self.limit},
+            )
+
+
+class ExportRevokedUsers(ListRevokedUsers):
+    """ Stream all users who've revoked active TOS as CSV or JSON-lines. """
+
+    fieldnames = ("userid", "name", "email", "tos_uid", "tos_title", "revoked")
+
+    def __call__(self):
+        fmt = self.request.params.get("format", "csv")
+        if fmt not in EXPORT_FORMATS:
+            raise HTTPNotFound(_("Unknown format"))
+        content_type, ext = EXPORT_FORMATS[fmt]
+        tos_uids = [x.uid for x in self.active_tos]
+        tos_titles = dict([(x.uid, x.title) for x in self.active_tos])
+        # Users are found and loaded as they're written
+        response = Response(
+            content_type=content_type,
+            charset="utf-8",
+            app_iter=self._stream(
+                fmt,
+                SeparateConnection(self.request.root),
+                self.request.root._p_oid,
+                tos_uids,
+                tos_titles,
+            ),
+        )
+        response.content_disposition = 'attachment; filename="revoked_tos.%s"' % ext
+        return response
+
+    def _stream(self, fmt, separate, root_oid, tos_uids, tos_titles):
+        with separate as conn:
+            revoked_users = iter_revoked_users(conn.get(root_oid), tos_uids)
+            rows = iter_revoked_rows(revoked_users, tos_titles, conn)
+            for chunk in encode_rows(rows, fmt, self.fieldnames):
+                yield chunk
+
+
+class ExportUserConsent(BaseView, TOSMixin):
+    """ Everything a user agreed to or revoked, as CSV or JSON-lines. """
+
+    def __call__(self):
+        fmt = self.request.params.get("format", "jsonl")
+        if fmt not in EXPORT_FORMATS:
+            raise HTTPNotFound(_("Unknown format"))
+        content_type, ext = EXPORT_FORMATS[fmt]
+        uids = set(split_consent_key(x)[0] for x in IAgreedTOS(self.context))
+        uids.update(IRevokedTOS(self.context))
+        tos_info = {}
+        for uid, tos in self.tos_manager.resolve_tos_uids(uids).items():
+            tos_info[uid] = {"title": tos.title, "revision": tos.revision, "lang": tos.lang}
+        rows = user_consent_rows(self.context, tos_info)
+        response = Response(
+            content_type=content_type,
+            charset="utf-8",
+            body=b"".join(encode_rows(rows, fmt, CONSENT_FIELDNAMES)),
+        )
+        response.content_disposition = 'attachment; filename="%s_consent.%s"' % (
+            self.context.userid,
+            ext,
+        )
+        return response
 
 
 class TOSSettings(BaseForm):
@@ -216,6 +491,9 @@ class TOSSettings(BaseForm):
 
 
 def terms_not_accepted(context, request):
+    # Enforcement state outside of the session must be cleared too,
+    # or the expired grace period would kick the user out again after login
+    ITOSManager(request).clear_state()
     headers = forget(request)
     request.session.invalidate()
     fm = IFlashMessages(request)
@@ -249,6 +527,13 @@ def includeme(config):
         permission=PERM_VIEW,
         renderer="arche:templates/form.pt",
     )
+    config.add_view(
+        PendingTOSJSON,
+        context=IRoot,
+        name="tos_pending.json",
+        permission=PERM_VIEW,
+        renderer="json",
+    )
     config.add_view(
         AgreedTOSView,
         context=IUser,
@@ -256,6 +541,12 @@ def includeme(config):
         permission=PERM_VIEW,
         renderer="arche_tos:templates/agreed_tos.pt",
     )
+    config.add_view(
+        ExportUserConsent,
+        context=IUser,
+        name="export_consent",
+        permission=PERM_EDIT,
+    )
     config.add_view(
         RevokeAgreementForm,
         context=IUser,
@@ -270,6 +561,13 @@ def includeme(config):
         permission=PERM_MANAGE_USERS,
         renderer="arche_tos:templates/manage_tos.pt",
     )
+    config.add_view(
+        ConsentDashboard,
+        context=IRoot,
+        name="_tos_consent_dashboard",
+        permission=PERM_MANAGE_USERS,
+        renderer="arche_tos:templates/consent_dashboard.pt",
+    )
     config.add_view(
         ListRevokedUsers,
         context=IRoot,
@@ -277,6 +575,12 @@ def includeme(config):
         permission=PERM_MANAGE_USERS,
         renderer="arche_tos:templates/list_revoked_users.pt",
     )
+    config.add_view(
+        ExportRevokedUsers,
+        context=IRoot,
+        name="_export_revoked_tos_users",
+        permission=PERM_MANAGE_USERS,
+    )
     config.add_view(
         TOSSettings,
         context=IRoot,
@@ -44,5 +44,15 @@ setup(
         'fanstatic.libraries': [
             'arche_tos = arche_tos.fanstatic_lib:library',
         ],
+        'console_scripts': [
+            'arche_tos_rebuild_index = arche_tos.scripts:rebuild_index',
+            'arche_tos_notify = arche_tos.scripts:notify',
+            'arche_tos_benchmark = arche_tos.benchmark:main',
+            'arche_tos_bulk = arche_tos.scripts:bulk',
+            'arche_tos_compact = arche_tos.scripts:compact',
+            'arche_tos_compact_log = arche_tos.scripts:compact_log',
+            'arche_tos_export = arche_tos.scripts:export',
+            'arche_tos_scan = arche_tos.scan:main',
+        ],
     },
 )